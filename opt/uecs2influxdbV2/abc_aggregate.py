@@ -1,49 +1,51 @@
-//----------------------------------------------------------------------
-// 2024.11.02 Aggregate TASK
-// 
-//  receive_ccm.json を参照して
-//    measurement の savemode=abc の場合、6時間毎に集計する    
-//  Exsample：
-//      集計先：buckt uecs  / measurement k_sht31temp_1_5_1
-//      格納先：buckt aggregate
-//          時間帯          measurement      tag
-//           0-6時      -->   ABC_0-6      k_sht31temp_1_5_1
-//           6-12時     -->   ABC_6-12     k_sht31temp_1_5_1
-//          12-18時     -->   ABC_12-18    k_sht31temp_1_5_1
-//          18-24時     -->   ABC_18-24    k_sht31temp_1_5_1
-//----------------------------------------------------------------------
-import json
+#----------------------------------------------------------------------
+# 2024.11.02 Aggregate TASK
+# 
+#  receive_ccm.json を参照して
+#    measurement の savemode=abc の場合、6時間毎に集計する    
+#  Exsample：
+#      集計先：buckt uecs  / measurement k_sht31temp_1_5_1
+#      格納先：buckt aggregate
+#          時間帯          measurement      tag
+#           0-6時      -->   ABC_0-6      k_sht31temp_1_5_1
+#           6-12時     -->   ABC_6-12     k_sht31temp_1_5_1
+#          12-18時     -->   ABC_12-18    k_sht31temp_1_5_1
+#          18-24時     -->   ABC_18-24    k_sht31temp_1_5_1
+#----------------------------------------------------------------------
 import configparser
 import logging,os
 from typing import List, Dict, Optional
-from datetime import datetime, timedelta
-from influxdb_client import InfluxDBClient, WriteOptions
-from influxdb_client.client.exceptions import InfluxDBError
-
-# ロギングの設定
-log_dir = 'log' 
-os.makedirs(log_dir, exist_ok=True) 
-log_filename = os.path.join(log_dir, f'uecs2influxdb_{datetime.now().strftime("%Y%m%d_%H%M%S")}.log')
-
-logging.basicConfig( 
-    level=logging.INFO, 
-    format='%(asctime)s - %(levelname)s - %(message)s', 
-    handlers=[ logging.FileHandler(log_filename),
-    logging.StreamHandler() 
-    ]
-)
+from datetime import datetime
+from ccm_rules import CCMRuleMatcher
+from influx_sinks import sink_targets
 
 logger = logging.getLogger(__name__)
 
+def setup_logging() -> None:
+    """ロギングの設定"""
+    log_dir = 'log' 
+    os.makedirs(log_dir, exist_ok=True) 
+    log_filename = os.path.join(log_dir, f'uecs2influxdb_{datetime.now().strftime("%Y%m%d_%H%M%S")}.log')
+
+    logging.basicConfig( 
+        level=logging.INFO, 
+        format='%(asctime)s - %(levelname)s - %(message)s', 
+        handlers=[ logging.FileHandler(log_filename),
+        logging.StreamHandler() 
+        ]
+    )
+
 class InfluxDBProcessor:
-    def __init__(self, config_path: str, ccm_path: str):
+    def __init__(self, config_path: str, ccm_path: str, section: str = 'influx2'):
         """
         設定ファイルとCCMファイルから初期化を行う
         
         Args:
             config_path (str): 設定ファイルのパス
             ccm_path (str): CCMファイルのパス
+            section (str): 集計するInfluxDBの設定セクション名（[sinks] targets のいずれか）
         """
+        self.section = section
         self.config = self._load_config(config_path)
         self.measurements = self._load_measurements(ccm_path)
         self.client = None
@@ -59,12 +61,13 @@ class InfluxDBProcessor:
         try:
             config = configparser.ConfigParser()
             config.read(config_path)
+            target = config[self.section]
             return {
-                'url': config['influx2']['url'],
-                'org': config['influx2']['org'],
-                'token': config['influx2']['token'],
-                'bucket': config['influx2']['bucket'],
-                'aggregate_bucket':config['influx2']['aggregate_bucket']
+                'url': target['url'],
+                'org': target['org'],
+                'token': target['token'],
+                'bucket': target['bucket'],
+                'aggregate_bucket':target.get('aggregate_bucket', config['influx2']['aggregate_bucket'])
             }
         except Exception as e:
             logger.error(f"設定ファイルの読み込みに失敗: {e}")
@@ -73,15 +76,19 @@ class InfluxDBProcessor:
     def _load_measurements(self, ccm_path: str) -> List[str]:
         """CCMファイルから測定値を読み込む"""
         try:
-            with open(ccm_path, 'r') as file:
-                data = json.load(file)
-            return [key for key, value in data.items() if value.get('savemode') == 'abc']
+            ccm_rules = CCMRuleMatcher.from_file(ccm_path)
+            for rule in ccm_rules.unbounded_rules():
+                if rule.savemode == 'abc':
+                    logger.warning(f"ワイルドカードを含むため集計対象を列挙できません: {rule.name}")
+            return list(ccm_rules.measurements('abc'))
         except Exception as e:
             logger.error(f"CCMファイルの読み込みに失敗: {e}")
             raise
 
     def connect(self):
         """InfluxDBに接続"""
+        from influxdb_client import InfluxDBClient  # 起動を軽くするため接続時に読み込む
+
         try:
             self.client = InfluxDBClient(
                 url=self.config['url'],
@@ -90,7 +97,7 @@ class InfluxDBProcessor:
             )
             # 接続テスト
             self.client.ping()
-            logger.info("InfluxDBに接続成功")
+            logger.info(f"InfluxDBに接続成功 ({self.section})")
         except Exception as e:
             logger.error(f"InfluxDBへの接続に失敗: {e}")
             raise
@@ -160,6 +167,8 @@ class InfluxDBProcessor:
 
     def process_data(self):
         """すべての測定値と時間範囲に対してクエリを実行"""
+        from influxdb_client.client.exceptions import InfluxDBError
+
         if not self.client:
             raise RuntimeError("InfluxDBクライアントが初期化されていません")
 
@@ -216,13 +225,23 @@ class InfluxDBProcessor:
                 logger.info("InfluxDB接続を終了")
 
 def main():
-    try:
-        processor = InfluxDBProcessor('uecs2influxdb.cfg', 'receive_ccm.json')
-        processor.connect()
-        processor.process_data()
-    except Exception as e:
-        logger.error(f"予期せぬエラーが発生: {e}")
-        raise
+    setup_logging()
+    config = configparser.ConfigParser()
+    config.read('uecs2influxdb.cfg')
+
+    # [sinks] で複数の書き込み先を指定している場合はそれぞれ集計する
+    failed = []
+    for target in sink_targets(config):
+        logger.info(f"集計開始: {target}")
+        try:
+            processor = InfluxDBProcessor('uecs2influxdb.cfg', 'receive_ccm.json', section=target)
+            processor.connect()
+            processor.process_data()
+        except Exception as e:
+            logger.error(f"予期せぬエラーが発生 ({target}): {e}")
+            failed.append(target)
+    if failed:
+        raise RuntimeError(f"集計に失敗した書き込み先: {', '.join(failed)}")
 
 if __name__ == "__main__":
     main()
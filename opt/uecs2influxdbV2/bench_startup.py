@@ -0,0 +1,150 @@
+#!/usr/bin/python3
+#----------------------------------------------------------------------
+# 起動時間・メモリ(RSS)の計測
+#
+#  各スクリプトの起動処理（設定・receive_ccm.json の読み込み、ソケットの
+#  bind、InfluxDBクライアントの生成まで）を別プロセスで実行し、
+#  起動時間と最大RSSを計測する。InfluxDBへの通信(ping)と受信データの記録は行わない。
+#  起動処理が失敗した場合(ImportError を含む)、pandas 等の重いモジュールが
+#  読み込まれた場合、上限値を超えた場合は終了コード 1 を返す。
+#  ※ uecs2influxdb.cfg と receive_ccm.json が必要
+#
+#  python bench_startup.py
+#  python bench_startup.py --max-sec 1.5 --max-rss-mb 60
+#----------------------------------------------------------------------
+import argparse
+import json
+import os
+import subprocess
+import sys
+from typing import Dict, List, Optional
+
+BASE_PATH = os.path.dirname(os.path.abspath(__file__))
+
+# 各スクリプトの起動処理（main() の受信・集計ループの手前まで）
+ENTRY_POINTS = {
+    "uecs2influxdb": """
+import asyncio
+from uecs2influxdb import Config, UECSReceiver
+ccm_rules, config = Config.load_config()
+# 稼働中の受信処理の記録ディレクトリを圧縮・削除しないよう記録は無効にする
+# （記録ファイルの保守処理は起動時間にも含めない）
+if config.has_section("journal"):
+    config["journal"]["enabled"] = "false"
+receiver = UECSReceiver(config, port=0)   # 稼働中の受信処理と重ならないよう空きポートで bind
+ready()
+receiver.close()
+""",
+    "make_ccm_json": """
+from socket import socket, AF_INET, SOCK_DGRAM
+import make_ccm_json
+make_ccm_json.read_ccm_json("receive_ccm.json")
+s = socket(AF_INET, SOCK_DGRAM)
+s.bind(("", 0))
+ready()
+s.close()
+""",
+    "abc_aggregate": """
+from abc_aggregate import InfluxDBProcessor
+from influxdb_client import InfluxDBClient
+processor = InfluxDBProcessor("uecs2influxdb.cfg", "receive_ccm.json")
+processor.client = InfluxDBClient(url=processor.config["url"], token=processor.config["token"],
+                                  org=processor.config["org"])
+ready()
+processor.client.close()
+""",
+    "replicate": """
+import replicate
+from influxdb import InfluxDBClient
+config = replicate.load_config("uecs2influxdb.cfg")
+measurement_filter = replicate.load_measurement_filter("receive_ccm.json")
+section = config["influx2"]
+client = InfluxDBClient(host=section["host_name"], port=int(section["port"]), username=section["user"],
+                        password=section["pass"], database=section["database"])
+ready()
+client.close()
+""",
+}
+
+MODULES = list(ENTRY_POINTS)
+
+# 起動時に読み込んではいけないモジュール
+FORBIDDEN = ["pandas", "numpy"]
+
+# 子プロセスで実行する計測処理（結果をJSONで出力）
+PROBE = '''
+import json, resource, sys, time, traceback
+start = time.perf_counter()
+result = {{"sec": None, "error": None}}
+def ready():
+    result["sec"] = time.perf_counter() - start
+    result["rss_mb"] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+    result["forbidden"] = [m for m in {forbidden!r} if m in sys.modules]
+try:
+    exec(compile({code!r}, "<{module}>", "exec"))
+    if result["sec"] is None:
+        raise RuntimeError("ready() が呼ばれていません")
+except BaseException as e:
+    result["error"] = f"{{type(e).__name__}}: {{e}}"
+    traceback.print_exc()
+print(json.dumps(result))
+'''
+
+
+def measure(module: str, repeat: int) -> Dict:
+    """module の起動処理を repeat 回計測し、最短時間と最大RSSを返す（失敗時は error）"""
+    probe = PROBE.format(module=module, code=ENTRY_POINTS[module], forbidden=FORBIDDEN)
+    results = []
+    for _ in range(repeat):
+        proc = subprocess.run([sys.executable, "-c", probe], cwd=BASE_PATH, capture_output=True, text=True)
+        try:
+            result = json.loads(proc.stdout.strip().splitlines()[-1])
+        except (IndexError, ValueError):
+            result = {"error": f"exit code {proc.returncode}"}
+        if result["error"]:
+            sys.stderr.write(proc.stderr)
+            return {"sec": float("nan"), "rss_mb": float("nan"), "forbidden": [], "error": result["error"]}
+        results.append(result)
+    return {
+        "sec": min(r["sec"] for r in results),
+        "rss_mb": max(r["rss_mb"] for r in results),
+        "forbidden": results[0]["forbidden"],
+        "error": results[0]["error"]
+    }
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    parser = argparse.ArgumentParser(description="起動時間・メモリ(RSS)の計測")
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--max-sec", type=float, default=None, help="起動時間の上限(秒)")
+    parser.add_argument("--max-rss-mb", type=float, default=None, help="最大RSSの上限(MB)")
+    parser.add_argument("modules", nargs="*", default=MODULES, help=f"計測対象 {MODULES}")
+    args = parser.parse_args(argv)
+    unknown = [m for m in args.modules if m not in ENTRY_POINTS]
+    if unknown:
+        parser.error(f"unknown module: {', '.join(unknown)}")
+
+    failed = False
+    print(f"{'module':<16}{'start(s)':>10}{'RSS(MB)':>10}  note")
+    for module in args.modules:
+        result = measure(module, args.repeat)
+        notes = []
+        if result["error"]:
+            notes.append(f"failed: {result['error']}")
+            failed = True
+        if result["forbidden"]:
+            notes.append("loaded " + ",".join(result["forbidden"]))
+            failed = True
+        if args.max_sec is not None and result["sec"] > args.max_sec:
+            notes.append(f"> {args.max_sec}s")
+            failed = True
+        if args.max_rss_mb is not None and result["rss_mb"] > args.max_rss_mb:
+            notes.append(f"> {args.max_rss_mb}MB")
+            failed = True
+        print(f"{module:<16}{result['sec']:>10.3f}{result['rss_mb']:>10.1f}  {' / '.join(notes)}")
+
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
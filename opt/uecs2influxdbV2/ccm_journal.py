@@ -0,0 +1,230 @@
+#!/usr/bin/python3
+#----------------------------------------------------------------------
+# 受信データ(CCM)の記録
+#
+#  受信したUDPパケットを受信時刻・送信元と共に追記形式で記録する。
+#  rotate_minutes 毎にファイルを切り替え、切り替えたファイルは gzip 圧縮する。
+#  記録したデータは replay.py で再処理（InfluxDBへ再格納）できる。
+#
+#  ファイル形式：ccm_YYYYmmdd_HHMM.jrnl(.gz)   ※時刻はUTC
+#      レコード = ヘッダ(受信時刻ns 8byte, IPv4 4byte, port 2byte, 長さ 2byte) + パケット
+#
+#  uecs2influxdb.cfg
+#      [journal]
+#      enabled=true
+#      dir=/home/pi/uecs_journal
+#      rotate_minutes=60
+#      compress=true
+#      keep_days=90
+#----------------------------------------------------------------------
+import gzip
+import os
+import re
+import shutil
+import socket
+import struct
+import threading
+import time
+import zlib
+import configparser
+from datetime import datetime, timezone
+from typing import Iterator, List, Optional, Tuple
+
+RECORD = struct.Struct("<qIHH")
+FILE_PATTERN = re.compile(r"^ccm_(\d{8}_\d{4})\.jrnl(\.gz)?$")
+FILE_TIME_FORMAT = "%Y%m%d_%H%M"
+COPY_CHUNK = 1024 * 1024
+
+
+def _file_time(name: str) -> Optional[int]:
+    """ファイル名から記録開始時刻(ns)を求める"""
+    m = FILE_PATTERN.match(name)
+    if not m:
+        return None
+    dt = datetime.strptime(m.group(1), FILE_TIME_FORMAT).replace(tzinfo=timezone.utc)
+    return int(dt.timestamp()) * 1_000_000_000
+
+
+def _complete_length(f) -> int:
+    """記録ファイルの完全なレコードまでの長さ（異常終了で書き込み途中となった末尾のレコードは除く）"""
+    size = os.fstat(f.fileno()).st_size
+    end = 0
+    while end + RECORD.size <= size:
+        f.seek(end)
+        length = RECORD.unpack(f.read(RECORD.size))[3]
+        if end + RECORD.size + length > size:
+            break
+        end += RECORD.size + length
+    return end
+
+
+def _compress(path: str) -> None:
+    """記録ファイルを gzip 圧縮して元ファイルを削除（圧縮済ファイルがあれば追記）
+
+    一時ファイルへ書き出してから置き換えるため、途中で停止しても圧縮済ファイルは壊れない。
+    置き換え後・元ファイル削除前に停止した場合は次回同じデータを追記するが、
+    同じ時刻のデータは InfluxDB で上書きされるため再処理には影響しない。
+    """
+    gz_path = path + ".gz"
+    tmp_path = gz_path + ".tmp"
+    with open(path, "rb") as src, open(tmp_path, "wb") as dst:
+        end = _complete_length(src)
+        if os.path.exists(gz_path):
+            with open(gz_path, "rb") as gz:
+                shutil.copyfileobj(gz, dst, COPY_CHUNK)
+        # gzip は複数メンバーの連結を1ファイルとして読める（メモリを使わないよう分割して圧縮）
+        src.seek(0)
+        with gzip.GzipFile(fileobj=dst, mode="wb") as member:
+            remaining = end
+            while remaining > 0:
+                chunk = src.read(min(COPY_CHUNK, remaining))
+                if not chunk:
+                    break
+                member.write(chunk)
+                remaining -= len(chunk)
+        dst.flush()
+        os.fsync(dst.fileno())
+    os.replace(tmp_path, gz_path)
+    os.remove(path)
+
+
+class PacketJournal:
+    """受信パケットを追記形式で記録するクラス"""
+    def __init__(self, directory: str, rotate_minutes: int = 60, compress: bool = True,
+                 keep_days: Optional[float] = None, flush_sec: float = 1.0):
+        self.directory = directory
+        self.period_ns = rotate_minutes * 60 * 1_000_000_000
+        self.compress = compress
+        self.keep_days = keep_days
+        self.flush_sec = flush_sec
+        os.makedirs(directory, exist_ok=True)
+
+        self._file = None
+        self._path: Optional[str] = None
+        self._period: Optional[int] = None
+        self._last_flush = 0.0
+        self._maintenance_lock = threading.Lock()
+
+        # 前回起動時の未圧縮ファイルを圧縮
+        self._rotate_done()
+
+    def _path_for(self, period: int) -> str:
+        dt = datetime.fromtimestamp(period * self.period_ns / 1_000_000_000, timezone.utc)
+        return os.path.join(self.directory, f"ccm_{dt.strftime(FILE_TIME_FORMAT)}.jrnl")
+
+    def append(self, data: bytes, addr: Tuple[str, int], received_ns: int) -> None:
+        """パケットを1件記録する"""
+        period = received_ns // self.period_ns
+        if period != self._period:
+            self._open(period)
+
+        try:
+            ip = struct.unpack("!I", socket.inet_aton(addr[0]))[0]
+        except OSError:
+            ip = 0
+        self._file.write(RECORD.pack(received_ns, ip, addr[1], len(data)) + data)
+
+        now = time.monotonic()
+        if now - self._last_flush >= self.flush_sec:
+            self._file.flush()
+            self._last_flush = now
+
+    def _open(self, period: int) -> None:
+        """記録ファイルを切り替える（前のファイルは別スレッドで圧縮）"""
+        self.close()
+        self._period = period
+        self._path = self._path_for(period)
+        self._file = open(self._path, "ab")
+        threading.Thread(target=self._rotate_done, daemon=True).start()
+
+    def _rotate_done(self) -> None:
+        """記録を終えたファイルの圧縮と、保存期間を過ぎたファイルの削除"""
+        with self._maintenance_lock:
+            # 記録中（未オープン時は現在時刻）のファイルは対象外
+            current = self._path or self._path_for(time.time_ns() // self.period_ns)
+            expire_ns = None
+            if self.keep_days:
+                expire_ns = time.time_ns() - int(self.keep_days * 86400) * 1_000_000_000
+
+            for name in sorted(os.listdir(self.directory)):
+                path = os.path.join(self.directory, name)
+                if name.startswith("ccm_") and name.endswith(".gz.tmp"):
+                    self._remove(path)   # 圧縮途中で停止した一時ファイル
+                    continue
+                started = _file_time(name)
+                if started is None or path == current:
+                    continue
+                try:
+                    if expire_ns is not None and started + self.period_ns < expire_ns:
+                        os.remove(path)
+                    elif self.compress and name.endswith(".jrnl"):
+                        _compress(path)
+                except OSError as e:
+                    print(f"Journal maintenance failed ({name}): {e}")
+
+    @staticmethod
+    def _remove(path: str) -> None:
+        try:
+            os.remove(path)
+        except OSError as e:
+            print(f"Journal maintenance failed ({os.path.basename(path)}): {e}")
+
+    def close(self) -> None:
+        if self._file:
+            self._file.close()
+            self._file = None
+
+
+def journal_files(directory: str, start_ns: int, stop_ns: int) -> List[str]:
+    """指定期間を含む記録ファイルを時刻順に返す"""
+    entries = []
+    for name in os.listdir(directory):
+        started = _file_time(name)
+        if started is not None:
+            entries.append((started, name))
+    entries.sort(key=lambda e: (e[0], e[1].endswith(".jrnl")))   # 同じ時間帯は圧縮済を先に
+
+    files = []
+    for started, name in entries:
+        # 次の時間帯のファイルの開始時刻までが記録範囲
+        ended = next((s for s, _ in entries if s > started), None)
+        if started < stop_ns and (ended is None or ended > start_ns):
+            files.append(os.path.join(directory, name))
+    return files
+
+
+def read_journal(directory: str, start_ns: int, stop_ns: int) -> Iterator[Tuple[int, Tuple[str, int], bytes]]:
+    """指定期間のパケットを (受信時刻ns, (送信元IP, port), パケット) で返す
+
+    壊れたファイル（圧縮途中で停止した .gz 等）は読めた所までを返し、次のファイルへ進む。
+    """
+    for path in journal_files(directory, start_ns, stop_ns):
+        opener = gzip.open if path.endswith(".gz") else open
+        try:
+            with opener(path, "rb") as f:
+                while True:
+                    header = f.read(RECORD.size)
+                    if len(header) < RECORD.size:
+                        break
+                    received_ns, ip, port, length = RECORD.unpack(header)
+                    data = f.read(length)
+                    if len(data) < length:
+                        break   # 書き込み途中で終了したレコード
+                    if start_ns <= received_ns < stop_ns:
+                        yield received_ns, (socket.inet_ntoa(struct.pack("!I", ip)), port), data
+        except (EOFError, gzip.BadGzipFile, zlib.error, OSError) as e:
+            print(f"Journal file is damaged, skipped the rest ({os.path.basename(path)}): {e}")
+
+
+def load_journal(config: configparser.ConfigParser) -> Optional[PacketJournal]:
+    """uecs2influxdb.cfg の [journal] から記録を構成する（無効の場合は None）"""
+    if not config.has_section("journal") or not config["journal"].getboolean("enabled", False):
+        return None
+    section = config["journal"]
+    keep_days = section.get("keep_days", "").strip()
+    return PacketJournal(
+        section.get("dir", "journal"),
+        rotate_minutes=section.getint("rotate_minutes", 60),
+        compress=section.getboolean("compress", True),
+        keep_days=float(keep_days) if keep_days else None
+    )
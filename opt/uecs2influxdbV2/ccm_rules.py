@@ -0,0 +1,230 @@
+#!/usr/bin/python3
+#----------------------------------------------------------------------
+# receive_ccm.json のルール照合
+#
+#  CCM を1件ずつ記述する通常の指定に加えて、type にワイルドカード、
+#  room / region / order に範囲・列挙・ワイルドカードを記述できる。
+#  読み込み時に type 毎の索引へコンパイルし、照合結果はキャッシュする。
+#
+#  Exsample：  room 1～8 の InAirTemp をすべて格納する
+#      "全ハウス 気温": {
+#          "type": "InAirTemp.mIC",
+#          "room": "1-8",
+#          "region": "*",
+#          "order": "1,2",
+#          "savemode": "1"
+#      }
+#
+#  優先順位：個別指定 > ルール（記述順で先に一致したもの）
+#  room / region / order の省略（空文字）は不可。すべての値は "*" で指定する。
+#
+#  python ccm_rules.py で照合の自己診断を実行する。
+#----------------------------------------------------------------------
+import json
+import fnmatch
+import re
+from functools import lru_cache
+from typing import Dict, Iterator, List, Optional, Tuple
+
+WILDCARD_CHARS = set("*?[")
+MAX_EXPAND = 10_000
+
+
+def ccm_key(data: Dict) -> str:
+    """receive_ccm.json の1件から measurement 名を生成する"""
+    return f"{data['type'].split('.')[0]}_{data['room']}_{data['region']}_{data['order']}".lower()
+
+
+def is_rule(data: Dict) -> bool:
+    """ワイルドカードや範囲を含むルール指定か判定"""
+    if WILDCARD_CHARS & set(data["type"].split(".")[0]):
+        return True
+    return any(not str(data[k]).strip().isdigit() for k in ("room", "region", "order"))
+
+
+class NumberSet:
+    """"1-8", "1,3,5", "*" 形式の数値指定"""
+    def __init__(self, spec: str):
+        self.spec = str(spec).strip()
+        self.ranges: Optional[List[Tuple[int, int]]] = None  # None は任意の値
+        if self.spec == "*":
+            return
+        self.ranges = []
+        for part in self.spec.split(","):
+            m = re.fullmatch(r"\s*(\d+)\s*(?:-\s*(\d+)\s*)?", part)
+            if not m:
+                raise ValueError(f"範囲指定が不正です: {spec}")
+            lo = int(m.group(1))
+            hi = int(m.group(2)) if m.group(2) else lo
+            self.ranges.append((min(lo, hi), max(lo, hi)))
+
+    def __contains__(self, value: str) -> bool:
+        if self.ranges is None:
+            return True
+        if not value.isdigit():
+            return False
+        n = int(value)
+        return any(lo <= n <= hi for lo, hi in self.ranges)
+
+    def values(self) -> Optional[List[int]]:
+        """列挙可能な場合は値の一覧を返す"""
+        if self.ranges is None:
+            return None
+        return sorted({n for lo, hi in self.ranges for n in range(lo, hi + 1)})
+
+
+class CCMRule:
+    """コンパイル済みのルール1件"""
+    def __init__(self, name: str, data: Dict, index: int = 0):
+        self.name = name
+        self.index = index
+        self.type_pattern = data["type"].split(".")[0].lower()
+        self.room = NumberSet(data["room"])
+        self.region = NumberSet(data["region"])
+        self.order = NumberSet(data["order"])
+        self.savemode = data.get("savemode") or ""
+        self.type_is_pattern = bool(WILDCARD_CHARS & set(self.type_pattern))
+
+    def match(self, ccm_type: str, room: str, region: str, order: str) -> bool:
+        if self.type_is_pattern:
+            if not fnmatch.fnmatchcase(ccm_type, self.type_pattern):
+                return False
+        elif ccm_type != self.type_pattern:
+            return False
+        return room in self.room and region in self.region and order in self.order
+
+    def expand(self) -> Optional[List[str]]:
+        """ルールに該当する measurement を列挙する（列挙できない場合は None）"""
+        if self.type_is_pattern:
+            return None
+        rooms, regions, orders = self.room.values(), self.region.values(), self.order.values()
+        if rooms is None or regions is None or orders is None:
+            return None
+        if len(rooms) * len(regions) * len(orders) > MAX_EXPAND:
+            return None
+        return [f"{self.type_pattern}_{r}_{g}_{o}" for r in rooms for g in regions for o in orders]
+
+
+class CCMRuleMatcher:
+    """measurement 名から savemode を求める照合器"""
+    def __init__(self, ccm_json: Dict[str, Dict], cache_size: int = 65536):
+        self.exact: Dict[str, str] = {}
+        self.rules: List[CCMRule] = []
+        self._by_type: Dict[str, List[CCMRule]] = {}
+        self._pattern_rules: List[CCMRule] = []
+
+        for name, data in ccm_json.items():
+            for field in ("type", "room", "region", "order"):
+                if not str(data.get(field, "")).strip():
+                    raise ValueError(f"{name}: {field} が指定されていません")
+
+            if is_rule(data):
+                rule = CCMRule(name, data, len(self.rules))
+                self.rules.append(rule)
+                if rule.type_is_pattern:
+                    self._pattern_rules.append(rule)
+                else:
+                    self._by_type.setdefault(rule.type_pattern, []).append(rule)
+            else:
+                # 同じCCMが重複する場合は savemode を指定したものを優先（先に記述したもの）
+                key, savemode = ccm_key(data), data.get("savemode") or ""
+                if not self.exact.get(key):
+                    self.exact[key] = savemode
+
+        self._resolve = lru_cache(maxsize=cache_size)(self._resolve_uncached)
+
+    @classmethod
+    def from_file(cls, path: str) -> "CCMRuleMatcher":
+        with open(path, "r", encoding="utf-8") as f:
+            return cls(json.load(f))
+
+    def _resolve_uncached(self, measurement: str) -> Optional[str]:
+        """savemode を返す（receive_ccm.json に該当なしの場合は None）"""
+        savemode = self.exact.get(measurement)
+        if savemode is not None:
+            return savemode
+
+        parts = measurement.rsplit("_", 3)
+        if len(parts) != 4:
+            return None
+
+        # type 完全一致の索引とワイルドカードtypeのルールを記述順に照合
+        candidates = self._by_type.get(parts[0], [])
+        if self._pattern_rules:
+            candidates = sorted(candidates + self._pattern_rules, key=lambda rule: rule.index)
+        for rule in candidates:
+            if rule.match(*parts):
+                return rule.savemode
+        return None
+
+    def lookup(self, measurement: str) -> str:
+        """savemode を返す（格納対象外の場合は空文字）"""
+        return self._resolve(measurement) or ""
+
+    def __contains__(self, measurement: str) -> bool:
+        """receive_ccm.json に記述済（ルール該当を含む）か判定"""
+        return self._resolve(measurement) is not None
+
+    def measurements(self, savemode: Optional[str] = None) -> Iterator[str]:
+        """列挙可能な measurement を返す（savemode 指定時はその値のもの）"""
+        seen = set()
+        for key, mode in self.exact.items():
+            seen.add(key)
+            if mode and (savemode is None or mode == savemode):
+                yield key
+        for rule in self.rules:
+            for key in rule.expand() or []:
+                if key in seen:
+                    continue
+                seen.add(key)
+                mode = self.lookup(key)
+                if mode and (savemode is None or mode == savemode):
+                    yield key
+
+    def unbounded_rules(self) -> List[CCMRule]:
+        """measurement を列挙できないルール"""
+        return [rule for rule in self.rules if rule.expand() is None]
+
+
+def _self_check() -> None:
+    """照合の自己診断（個別指定の優先・範囲指定・ルールの記述順）"""
+    matcher = CCMRuleMatcher({
+        "気温 ルール": {"type": "InAirTemp.mIC", "room": "1-3,5", "region": "*", "order": "1", "savemode": "1"},
+        "気温 全type": {"type": "*Temp.mIC", "room": "*", "region": "*", "order": "*", "savemode": "diff"},
+        "気温 個別": {"type": "InAirTemp.mIC", "room": "2", "region": "1", "order": "1", "savemode": ""},
+        "日射 重複1": {"type": "WRadiation.mIC", "room": "1", "region": "1", "order": "1", "savemode": ""},
+        "日射 重複2": {"type": "WRadiation.mIC", "room": "1", "region": "1", "order": "1", "savemode": "abc"},
+    })
+    # 個別指定はルールより優先（savemode なしでも格納対象外）
+    assert matcher.lookup("inairtemp_2_1_1") == ""
+    assert "inairtemp_2_1_1" in matcher
+    # 範囲・列挙
+    assert matcher.lookup("inairtemp_3_1_1") == "1"
+    assert matcher.lookup("inairtemp_5_9_1") == "1"
+    # 範囲外は後のルールに一致
+    assert matcher.lookup("inairtemp_4_1_1") == "diff"
+    assert matcher.lookup("inairtemp_1_1_2") == "diff"
+    assert matcher.lookup("soiltemp_7_1_1") == "diff"
+    assert "wairhumid_1_1_1" not in matcher
+    # 重複時は savemode 指定ありを優先
+    assert matcher.lookup("wradiation_1_1_1") == "abc"
+
+    ns = NumberSet("8-6, 10")
+    assert ns.values() == [6, 7, 8, 10] and "7" in ns and "9" not in ns and "x" not in ns
+    for spec in ("", "1-", "a", "1;2"):
+        try:
+            NumberSet(spec)
+        except ValueError:
+            continue
+        raise AssertionError(f"NumberSet({spec!r}) は不正な指定です")
+    try:
+        CCMRuleMatcher({"room なし": {"type": "InAirTemp.mIC", "room": "", "region": "1", "order": "1", "savemode": "1"}})
+    except ValueError:
+        pass
+    else:
+        raise AssertionError("room の省略は不可")
+    print("ccm_rules: self check ok")
+
+
+if __name__ == "__main__":
+    _self_check()
@@ -0,0 +1,334 @@
+#!/usr/bin/python3
+#----------------------------------------------------------------------
+# InfluxDB 書き込み先(シンク)の管理
+#
+#  uecs2influxdb.cfg の [sinks] セクションに複数のInfluxDBを指定し、
+#  measurement(既定は room 単位)を consistent hashing で振り分ける。
+#  replicas=2 以上にするとリング上の隣のノードへミラーリングする。
+#
+#  Exsample：
+#      [sinks]
+#      targets=influx2,influx2_node2
+#      shard_key=room
+#      replicas=1
+#
+#      [influx2_node2]
+#      url=http://192.168.1.20:8086
+#      org=...
+#      token=...
+#      bucket=uecs
+#----------------------------------------------------------------------
+from __future__ import annotations
+
+import bisect
+import hashlib
+import threading
+import time
+import configparser
+from typing import Dict, List, Optional, TYPE_CHECKING
+
+if TYPE_CHECKING:
+    from influxdb_client import WriteOptions
+
+
+class HashRing:
+    """仮想ノード付きの consistent hashing リング"""
+    def __init__(self, nodes: List[str], vnodes: int = 64):
+        self.nodes = list(nodes)
+        self._ring = sorted(
+            (self._hash(f"{node}#{i}"), node) for node in self.nodes for i in range(vnodes)
+        )
+        self._hashes = [h for h, _ in self._ring]
+        self._cache: Dict[str, List[str]] = {}
+
+    @staticmethod
+    def _hash(key: str) -> int:
+        return int.from_bytes(hashlib.md5(key.encode()).digest()[:8], "big")
+
+    def preference_list(self, key: str) -> List[str]:
+        """key の担当ノードから順に、全ノードを重複なしで返す"""
+        nodes = self._cache.get(key)
+        if nodes is not None:
+            return nodes
+
+        nodes = []
+        start = bisect.bisect(self._hashes, self._hash(key))
+        for i in range(len(self._ring)):
+            node = self._ring[(start + i) % len(self._ring)][1]
+            if node not in nodes:
+                nodes.append(node)
+                if len(nodes) == len(self.nodes):
+                    break
+        self._cache[key] = nodes
+        return nodes
+
+
+class InfluxSink:
+    """1台のInfluxDBへのバッチ書き込みと死活状態を管理するクラス"""
+    def __init__(self, name: str, section: configparser.SectionProxy,
+                 write_options: WriteOptions, retry_sec: float = 60.0, max_failures: int = 3):
+        from influxdb_client import InfluxDBClient
+
+        self.name = name
+        self.bucket = section["bucket"]
+        self.org = section.get("org", "").strip()
+        self.client = InfluxDBClient(
+            url=section["url"],
+            token=section.get("token", "").strip(),
+            org=self.org,
+            timeout=section.getint("timeout", 6000),
+            verify_ssl=section.getboolean("verify_ssl", True)
+        )
+        self.retry_sec = retry_sec
+        self.max_failures = max_failures
+
+        # 死活状態
+        self.healthy = True
+        self.failures = 0
+        self.last_error: Optional[str] = None
+        self.last_failure = 0.0
+        self.written = 0
+
+        self.write_api = self.client.write_api(
+            write_options=write_options,
+            success_callback=self._on_success,
+            error_callback=self._on_error,
+            retry_callback=self._on_retry
+        )
+        self.query_api = self.client.query_api()
+
+    def _on_success(self, conf, data):
+        self.failures = 0
+        self.written += 1
+        if not self.healthy:
+            print(f"Sink {self.name}: recovered")
+        self.healthy = True
+
+    def _on_error(self, conf, data, exception):
+        self._mark_failure(exception)
+        self.healthy = False
+        print(f"Sink {self.name}: batch dropped: {exception}")
+
+    def _on_retry(self, conf, data, exception):
+        self._mark_failure(exception)
+        if self.failures >= self.max_failures and self.healthy:
+            self.healthy = False
+            print(f"Sink {self.name}: marked unhealthy: {exception}")
+
+    def _mark_failure(self, exception):
+        self.failures += 1
+        self.last_error = str(exception)
+        self.last_failure = time.time()
+
+    def is_available(self) -> bool:
+        """書き込み可能か判定（受信処理から呼ばれるため通信は行わない）"""
+        return self.healthy
+
+    def probe(self) -> None:
+        """異常時に retry_sec 毎に ping で復帰を確認する（監視スレッドから呼ぶ）"""
+        if self.healthy or time.time() - self.last_failure < self.retry_sec:
+            return
+        try:
+            if self.client.ping():
+                self.failures = 0
+                self.healthy = True
+                print(f"Sink {self.name}: ping ok, resuming writes")
+                return
+        except Exception as e:
+            self.last_error = str(e)
+        self.last_failure = time.time()
+
+    def write(self, record: Dict):
+        """バッチ書き込みキューへ追加"""
+        self.write_api.write(bucket=self.bucket, org=self.org, record=record,
+                             write_precision="ns")
+
+    def write_batch(self, records: List[Dict]):
+        """まとめて書き込む（synchronous の場合は書き込み完了まで待つ）"""
+        try:
+            self.write_api.write(bucket=self.bucket, org=self.org, record=records,
+                                 write_precision="ns")
+        except Exception as e:
+            self._mark_failure(e)
+            raise
+        self.written += 1
+
+    def status(self) -> Dict:
+        return {
+            "healthy": self.healthy,
+            "failures": self.failures,
+            "written_batches": self.written,
+            "last_error": self.last_error
+        }
+
+    def close(self):
+        """未送信データを書き込んで接続を閉じる"""
+        try:
+            self.write_api.close()
+        finally:
+            self.client.close()
+
+
+class SinkRouter:
+    """measurement を担当シンクへ振り分けるクラス"""
+    def __init__(self, sinks: List[InfluxSink], shard_key: str = "room",
+                 replicas: int = 1, vnodes: int = 64, status_sec: float = 600.0,
+                 check_sec: float = 5.0):
+        if not sinks:
+            raise ValueError("書き込み先(sink)が指定されていません")
+        if shard_key not in ("room", "measurement"):
+            raise ValueError(f"shard_key は room / measurement のいずれかです: {shard_key}")
+        self.sinks = {sink.name: sink for sink in sinks}
+        self.shard_key = shard_key
+        self.replicas = max(1, min(replicas, len(sinks)))
+        self.ring = HashRing(list(self.sinks), vnodes)
+
+        # 死活監視（ping と状態出力は受信処理を止めないよう別スレッドで行う）
+        self.status_sec = status_sec
+        self.check_sec = check_sec
+        self._stop = threading.Event()
+        self._monitor = threading.Thread(target=self._monitor_loop, daemon=True)
+        self._monitor.start()
+
+    def _monitor_loop(self):
+        last_status = time.time()
+        while not self._stop.wait(self.check_sec):
+            for sink in self.sinks.values():
+                try:
+                    sink.probe()
+                except Exception as e:
+                    print(f"Sink {sink.name}: probe failed: {e}")
+            if self.status_sec and time.time() - last_status >= self.status_sec:
+                self.log_status()
+                last_status = time.time()
+
+    def log_status(self):
+        """各シンクの状態を出力する"""
+        for name, status in self.status().items():
+            state = "healthy" if status["healthy"] else "UNHEALTHY"
+            print(f"Sink {name}: {state}, written batches: {status['written_batches']}, "
+                  f"failures: {status['failures']}, last error: {status['last_error']}")
+
+    def _key(self, measurement: str) -> str:
+        """振り分けキー（measurement は type_room_region_order）"""
+        if self.shard_key == "room":
+            parts = measurement.rsplit("_", 3)
+            if len(parts) == 4:
+                return parts[1]
+        return measurement
+
+    def sinks_for(self, measurement: str) -> List[InfluxSink]:
+        """書き込み先のシンク（担当ノード＋ミラー）を返す
+
+        担当ノードが異常な場合はリング上の次の正常なノードへ振り替える。
+        """
+        selected = []
+        for name in self.ring.preference_list(self._key(measurement)):
+            sink = self.sinks[name]
+            if sink.is_available():
+                selected.append(sink)
+                if len(selected) == self.replicas:
+                    break
+        return selected
+
+    def query_sink(self, measurement: str) -> Optional[InfluxSink]:
+        """問い合わせ先のシンク（担当ノードのうち正常なもの）を返す"""
+        sinks = self.sinks_for(measurement)
+        return sinks[0] if sinks else None
+
+    def write(self, record: Dict) -> int:
+        """担当シンクへ書き込み、書き込んだシンク数を返す"""
+        sinks = self.sinks_for(record["measurement"])
+        if not sinks:
+            print(f"No available sink for {record['measurement']}, dropped")
+        for sink in sinks:
+            sink.write(record)
+        return len(sinks)
+
+    def write_batch(self, records: List[Dict]) -> int:
+        """担当シンク毎にまとめて書き込み、書き込んだ件数を返す"""
+        batches: Dict[str, List[Dict]] = {}
+        written = 0
+        for record in records:
+            sinks = self.sinks_for(record["measurement"])
+            if not sinks:
+                print(f"No available sink for {record['measurement']}, dropped")
+                continue
+            for sink in sinks:
+                batches.setdefault(sink.name, []).append(record)
+            written += 1
+        for name, batch in batches.items():
+            self.sinks[name].write_batch(batch)
+        return written
+
+    def status(self) -> Dict[str, Dict]:
+        return {name: sink.status() for name, sink in self.sinks.items()}
+
+    def close(self):
+        self._stop.set()
+        self.log_status()
+        for sink in self.sinks.values():
+            try:
+                sink.close()
+            except Exception as e:
+                print(f"Error closing sink {sink.name}: {e}")
+
+
+def sink_targets(config: configparser.ConfigParser) -> List[str]:
+    """書き込み先のセクション名（[sinks] targets、未指定時は influx2）
+
+    集計・連携・削除などのジョブは、すべての書き込み先に対して実行する。
+    """
+    targets = ["influx2"]
+    if config.has_section("sinks"):
+        targets = [t.strip() for t in config["sinks"].get("targets", "influx2").split(",") if t.strip()]
+    return targets
+
+
+def load_sinks(config: configparser.ConfigParser, batch_size: int = 500,
+               flush_interval: int = 10_000, synchronous: bool = False) -> SinkRouter:
+    """uecs2influxdb.cfg から書き込み先を構成する
+
+    [sinks] セクションがない場合は [influx2] のみへ書き込む。
+    synchronous の場合は SinkRouter.write_batch で書き込み完了まで待つ（replay.py 用）。
+    influxdb_client は読み込みに時間がかかるため、ここで初めて読み込む。
+    """
+    from influxdb_client import WriteOptions
+    from influxdb_client.client.write_api import SYNCHRONOUS
+
+    sinks_conf = config["sinks"] if config.has_section("sinks") else {}
+    targets = sink_targets(config)
+
+    if synchronous:
+        write_options = SYNCHRONOUS
+    else:
+        write_options = WriteOptions(
+            batch_size=batch_size,
+            flush_interval=flush_interval,
+            jitter_interval=2_000,
+            retry_interval=5_000,
+            max_retries=5,
+            max_retry_delay=30_000,
+            exponential_base=2
+        )
+
+    sinks = []
+    for target in targets:
+        if not config.has_section(target):
+            raise ValueError(f"Missing section: {target}")
+        sinks.append(InfluxSink(
+            target, config[target], write_options,
+            retry_sec=float(sinks_conf.get("retry_sec", 60)),
+            max_failures=int(sinks_conf.get("max_failures", 3))
+        ))
+
+    router = SinkRouter(
+        sinks,
+        shard_key=sinks_conf.get("shard_key", "room").strip(),
+        replicas=int(sinks_conf.get("replicas", 1)),
+        vnodes=int(sinks_conf.get("vnodes", 64)),
+        status_sec=float(sinks_conf.get("status_sec", 600))
+    )
+    if len(sinks) > 1:
+        print(f"Sinks: {', '.join(targets)} (shard_key={router.shard_key}, replicas={router.replicas})")
+    return router
@@ -2,24 +2,15 @@ from socket import *
 import json,os,subprocess
 import time as t
 import xmltodict
-import pandas as pd
+from ccm_rules import CCMRuleMatcher
 
 def read_ccm_json(ccm_json):
-    ccm_list=[]
-    df = pd.read_json(ccm_json ) 
+    ccm_rules = CCMRuleMatcher.from_file(ccm_json)   # ルール指定も含めて照合器へコンパイル
 
-    json_key_list=[]
-    for c in df.columns.values:
-        json_key  = df.loc['type', c] .split(".")[0].lower()   #df.loc[インデックス名, カラム名]
-        json_key += "_"+ df.loc['room', c]
-        json_key += "_"+ df.loc['region', c]
-        json_key += "_"+ df.loc['order', c]
-        json_key_list.append(json_key)
+    with open(ccm_json, 'r', encoding='utf-8') as f:
+        ccm_dict = json.load(f)
 
-    df.loc["json_key"]=json_key_list  
-    df=df.transpose()   #行と列入れ替え
-
-    return set(json_key_list),df
+    return ccm_rules,ccm_dict
 
 
 def kill_uecs_proc():
@@ -50,9 +41,10 @@ def start_uecs_proc():
 def capture_ccm(sec_time=50):
     #jsonファイルを読み込む
     ccm_json = os.path.dirname(os.path.abspath(__file__)) + '/receive_ccm.json' #CNF
-    json_key_list,df_json=set([]),None
+    json_key_list,ccm_dict=set([]),{}
+    ccm_rules=CCMRuleMatcher({})
     if os.path.exists(ccm_json):
-        json_key_list,df_json = read_ccm_json(ccm_json)        
+        ccm_rules,ccm_dict = read_ccm_json(ccm_json)        
 
     print('-------------------------------------')
     print(' 以下のCCMを取り込んでいます.........')
@@ -81,7 +73,7 @@ def capture_ccm(sec_time=50):
                     +"_"+ json_object["UECS"]["DATA"]["region"] \
                     +"_"+ json_object["UECS"]["DATA"]["order"]
 
-        if ccm_key not in json_key_list:
+        if ccm_key not in json_key_list and ccm_key not in ccm_rules:   # 記述済・ルール該当は追加しない
             add_ccm.append({
                      "type":       json_object["UECS"]["DATA"]["type"] #.split(".")[0].lower()
                     ,"room":       json_object["UECS"]["DATA"]["room"]
@@ -98,26 +90,15 @@ def capture_ccm(sec_time=50):
                     , " 残り:"+str(sec_time-round(end - start,1))+"秒 "
                     ,ccm_key)
 
-    # キャプチャしたデータをDataframe化
-    df_ccm = pd.DataFrame(add_ccm ,columns= ['type','room','region','order','sendlevel','savemode','json_key'])
-
-    # CCM受信の場合は、json_key をindexにする json_keyはなくなる
-    df_ccm = df_ccm.set_index('json_key')
+    # receive_ccm.json と CCMキャプチャとの結合（CCM受信の場合は json_key をキーにする）
+    for ccm in add_ccm:
+        ccm_dict[ccm.pop('json_key')] = ccm
 
-    # receive_ccm.json と CCMキャプチャとの結合
-    if df_json is not None:
-        df = df_json.append(df_ccm)
-    else:
-        df = df_ccm
     # ソート
-    df.sort_values(['room','region','order','type'],ignore_index=False, inplace = True)  
-    if 'json_key' in df.columns :
-        df.drop(columns='json_key', inplace=True) #json_key削除
-
-    output_json = df.to_json(orient="index",force_ascii=False)   #形式を指定: 全角文字（日本語）などのUnicodeエスケープ指定
-    parsed_output_json = json.loads(output_json)
+    sort_key = lambda item: tuple(str(item[1].get(k, '')) for k in ('room','region','order','type'))
+    parsed_output_json = dict(sorted(ccm_dict.items(), key=sort_key))
 
-    if len(df_ccm)>0: #変更があれば
+    if len(add_ccm)>0: #変更があれば
         path = os.path.dirname(os.path.abspath(__file__)) + '/receive_ccm.json' #CCMのデータをreceive_ccm.jsonに保存する
         with open(path, 'w') as f:
             json.dump(parsed_output_json, f,indent=4, ensure_ascii=False)
@@ -131,6 +112,7 @@ def capture_ccm(sec_time=50):
         print('-------------------------------------------------')
 
 
-kill_uecs_proc()
-capture_ccm(sec_time=60)  # 60秒間データ受信する
-start_uecs_proc()
+if __name__ == "__main__":
+    kill_uecs_proc()
+    capture_ccm(sec_time=60)  # 60秒間データ受信する
+    start_uecs_proc()
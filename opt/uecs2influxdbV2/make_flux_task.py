@@ -0,0 +1,325 @@
+#!/usr/bin/python3
+#----------------------------------------------------------------------
+# receive_ccm.json / uecs2influxdb.cfg から InfluxDB の TASK を生成する
+#
+#  abc_aggregateTASK.flux / downsampling.flux は measurement 毎・時間帯毎に
+#  手書きしていたが、本スクリプトで1ジョブ1TASKにまとめて生成する。
+#  各TASKは元データを1回だけ読み込み、全measurement・全時間帯を集計する。
+#
+#  python make_flux_task.py              --> tasks/ に .flux を出力
+#  python make_flux_task.py --register   --> 出力したTASKをInfluxDBへ登録(更新)
+#
+#  replay.py で過去データを再格納した場合は、同じ集計を期間を指定して実行する
+#  （aggregate_range。TASKは直近1～2日分しか集計しないため）。
+#----------------------------------------------------------------------
+import argparse
+import configparser
+import os
+import re
+from datetime import datetime, timedelta, timezone
+from typing import Dict, List, Optional
+from ccm_rules import CCMRuleMatcher, CCMRule
+from influx_sinks import sink_targets
+
+BASE_PATH = os.path.dirname(os.path.abspath(__file__))
+
+# abc_aggregate.py と同じ時間帯
+TIME_RANGES = [
+    {"start_hour": 0, "stop_hour": 6, "prefix": "ABC_0-6"},
+    {"start_hour": 6, "stop_hour": 12, "prefix": "ABC_6-12"},
+    {"start_hour": 12, "stop_hour": 18, "prefix": "ABC_12-18"},
+    {"start_hour": 18, "stop_hour": 24, "prefix": "ABC_18-24"},
+]
+
+# ダウンサンプリングの集計間隔(分)（retention.py が集計済みかの判定に使用）
+DOWNSAMPLE_MINUTES = 10
+
+ABC_TASK_NAME = "Daily Time Range Aggregation"
+DOWNSAMPLE_TASK_NAME = "aggregate(24ｈ)"
+TASK_FILES = {
+    ABC_TASK_NAME: "abc_aggregateTASK.flux",
+    DOWNSAMPLE_TASK_NAME: "downsampling.flux",
+}
+
+
+def _type_pattern(pattern: str) -> str:
+    """fnmatch 形式の type を正規表現へ変換（[!x] は [^x] とする）"""
+    regex, i, n = "", 0, len(pattern)
+    while i < n:
+        c = pattern[i]
+        i += 1
+        if c == "*":
+            regex += ".*"
+        elif c == "?":
+            regex += "."
+        elif c == "[":
+            j = i
+            if j < n and pattern[j] == "!":
+                j += 1
+            if j < n and pattern[j] == "]":
+                j += 1
+            while j < n and pattern[j] != "]":
+                j += 1
+            if j >= n:
+                regex += "\\["   # 閉じていない [ は文字として扱う
+                continue
+            chars = pattern[i:j].replace("\\", "\\\\")
+            i = j + 1
+            if chars.startswith("!"):
+                chars = "^" + chars[1:]
+            elif chars.startswith("^"):
+                chars = "\\" + chars
+            regex += "[" + chars + "]"
+        else:
+            regex += re.escape(c)
+    return regex
+
+
+def _rule_pattern(rule: CCMRule) -> str:
+    """ルールを measurement の正規表現へ変換"""
+    if rule.type_is_pattern:
+        ccm_type = _type_pattern(rule.type_pattern)
+    else:
+        ccm_type = re.escape(rule.type_pattern)
+
+    numbers = []
+    for number_set in (rule.room, rule.region, rule.order):
+        values = number_set.values()
+        numbers.append("[0-9]+" if values is None else "(?:" + "|".join(map(str, values)) + ")")
+    return ccm_type + "_" + "_".join(numbers)
+
+
+def _flux_regex(patterns: List[str]) -> str:
+    """正規表現の一覧を Flux の正規表現リテラルへまとめる"""
+    # Flux の正規表現リテラル内では / をエスケープする
+    return "/^(" + "|".join(patterns).replace("/", "\\/") + ")$/"
+
+
+def measurement_filter(ccm_rules: CCMRuleMatcher, savemode: Optional[str] = None) -> Optional[str]:
+    """対象 measurement を選ぶ Flux の条件式（対象なしの場合は None）
+
+    列挙できる measurement はそのまま列挙し、列挙できないルールは
+    CCMRuleMatcher と同じ優先順位（個別指定 > 先に記述したルール）となるよう、
+    対象外の個別指定と、それより前に記述した対象外のルールを除外する。
+    """
+    def selected(mode: str) -> bool:
+        return bool(mode) and (savemode is None or mode == savemode)
+
+    conditions = []
+    listed = sorted(ccm_rules.measurements(savemode))
+    if listed:
+        conditions.append(f"r._measurement =~ {_flux_regex([re.escape(m) for m in listed])}")
+
+    rule_conditions = []
+    for rule in ccm_rules.unbounded_rules():
+        if not selected(rule.savemode):
+            continue
+        condition = f"r._measurement =~ {_flux_regex([_rule_pattern(rule)])}"
+        earlier = [_rule_pattern(e) for e in ccm_rules.rules[:rule.index] if not selected(e.savemode)]
+        if earlier:
+            condition += f" and r._measurement !~ {_flux_regex(earlier)}"
+        rule_conditions.append(f"({condition})")
+
+    if rule_conditions:
+        condition = " or ".join(rule_conditions)
+        excluded = sorted(key for key, mode in ccm_rules.exact.items() if not selected(mode))
+        if excluded:
+            condition = f"r._measurement !~ {_flux_regex([re.escape(m) for m in excluded])} and ({condition})"
+        conditions.append(f"({condition})")
+
+    return " or ".join(conditions) or None
+
+
+def band_expression(var: str = "h") -> str:
+    """時刻(時)から集計先 measurement を求める Flux 式"""
+    expr = f'"{TIME_RANGES[-1]["prefix"]}"'
+    for time_range in reversed(TIME_RANGES[:-1]):
+        expr = f'if {var} < {time_range["stop_hour"]} then "{time_range["prefix"]}" else {expr}'
+    return expr
+
+
+def flux_time(dt: datetime) -> str:
+    """Flux の時刻リテラル(RFC3339, UTC)"""
+    return dt.astimezone(timezone.utc).strftime('%Y-%m-%dT%H:%M:%SZ')
+
+
+def abc_pipeline(config: Dict, measurements: str, start: str, stop: str) -> str:
+    """時間帯別平均(ABC_*)を集計して格納する Flux（import "date" が必要）"""
+    return f'''from(bucket: "{config['bucket']}")
+    |> range(start: {start}, stop: {stop})
+    |> filter(fn: (r) => {measurements})
+    |> filter(fn: (r) => r._field == "value")
+    |> map(
+        fn: (r) => {{
+            h = date.hour(t: r._time)
+
+            return {{r with original_measurement: r._measurement, _measurement: {band_expression()}}}
+        }},
+    )
+    |> group(columns: ["_measurement", "original_measurement", "_field"])
+    |> aggregateWindow(every: 1d, fn: mean, createEmpty: false)
+    |> to(bucket: "{config['aggregate_bucket']}", org: "{config['org']}", tagColumns: ["original_measurement"])
+'''
+
+
+def downsampling_pipeline(config: Dict, measurements: str, start: str, stop: str, every: str) -> str:
+    """every 間隔の平均へダウンサンプリングして格納する Flux"""
+    return f'''from(bucket: "{config['bucket']}")
+    |> range(start: {start}, stop: {stop})
+    |> filter(fn: (r) => {measurements})
+    |> filter(fn: (r) => r._field == "value" and r.cloud == "0" and r.downsample == "0")
+    |> aggregateWindow(every: {every}, fn: mean, createEmpty: false)
+    |> set(key: "downsample", value: "1")
+    |> to(bucket: "{config['aggregate_bucket']}", org: "{config['org']}")
+'''
+
+
+def generate_abc_task(config: Dict, measurements: str) -> str:
+    """savemode=abc の時間帯別平均を1回の読み込みで集計する TASK"""
+    return f'''//----------------------------------------------------------------------
+// make_flux_task.py により自動生成（receive_ccm.json の savemode=abc）
+//   集計先：bucket {config['bucket']}
+//   格納先：bucket {config['aggregate_bucket']}
+//   measurement：時間帯(ABC_0-6 等)  tag original_measurement：元のmeasurement
+//----------------------------------------------------------------------
+import "date"
+
+// task名 1日毎に実施
+option task = {{name: "{ABC_TASK_NAME}", every: 24h}}
+// 1日前のデータに限る
+option v = {{timeRangeStart: -2d, timeRangeStop: -1d}}
+
+{abc_pipeline(config, measurements, "v.timeRangeStart", "v.timeRangeStop")}'''
+
+
+def generate_downsampling_task(config: Dict, measurements: str) -> str:
+    """格納対象の全measurementを10分平均へダウンサンプリングする TASK"""
+    return f'''//----------------------------------------------------------------------
+// make_flux_task.py により自動生成（receive_ccm.json の savemode 指定あり）
+//   bucket {config['bucket']} --> {config['aggregate_bucket']} へダウンサンプリング
+//   ダウンサンプリングしたデータは downsample="1" で格納する
+//----------------------------------------------------------------------
+
+// task名 1時間毎に実施
+option task = {{name: "{DOWNSAMPLE_TASK_NAME}", every: 1h}}
+// 1日前から現在まで{DOWNSAMPLE_MINUTES}分間隔で。
+option v = {{timeRangeStart: -1d, timeRangeStop: now(), windowPeriod: {DOWNSAMPLE_MINUTES}m}}
+
+{downsampling_pipeline(config, measurements, "v.timeRangeStart", "v.timeRangeStop", "v.windowPeriod")}'''
+
+
+def load_config(config_path: str) -> Dict[str, Dict]:
+    """設定ファイルを読み込む（書き込み先([sinks])毎の設定を返す）"""
+    config = configparser.ConfigParser()
+    if not config.read(config_path):
+        raise FileNotFoundError(f"Configuration file not found: {config_path}")
+
+    configs = {}
+    for target in sink_targets(config):
+        section = config[target]
+        configs[target] = {
+            'url': section['url'],
+            'org': section['org'].strip(),
+            'token': section['token'].strip(),
+            'bucket': section['bucket'],
+            'aggregate_bucket': section.get('aggregate_bucket', config['influx2']['aggregate_bucket'])
+        }
+    return configs
+
+
+def generate_tasks(config: Dict, ccm_rules: CCMRuleMatcher) -> Dict[str, str]:
+    """TASK名 --> Flux の辞書を生成する"""
+    tasks = {}
+
+    measurements = measurement_filter(ccm_rules, 'abc')
+    if measurements:
+        tasks[ABC_TASK_NAME] = generate_abc_task(config, measurements)
+    else:
+        print("savemode=abc の measurement がないため集計TASKは生成しません")
+
+    measurements = measurement_filter(ccm_rules)
+    if measurements:
+        tasks[DOWNSAMPLE_TASK_NAME] = generate_downsampling_task(config, measurements)
+    else:
+        print("格納対象の measurement がないためダウンサンプリングTASKは生成しません")
+
+    return tasks
+
+
+def aggregate_range(config: Dict, ccm_rules: CCMRuleMatcher, start: datetime, stop: datetime) -> None:
+    """指定期間のダウンサンプリングと時間帯別集計を実行する（replay.py で再格納した期間用）
+
+    集計値が1日分の途中で切れないよう、期間はUTCの日単位に広げて1日ずつ実行する。
+    """
+    from influxdb_client import InfluxDBClient
+
+    downsample = measurement_filter(ccm_rules)
+    abc = measurement_filter(ccm_rules, 'abc')
+    day = timedelta(days=1)
+    epoch = datetime(1970, 1, 1, tzinfo=timezone.utc)
+    day_start = epoch + (start - epoch) // day * day
+
+    with InfluxDBClient(url=config['url'], token=config['token'], org=config['org'], timeout=600_000) as client:
+        query_api = client.query_api()
+        while day_start < stop:
+            day_stop = day_start + day
+            if downsample:
+                query_api.query(org=config['org'], query=downsampling_pipeline(
+                    config, downsample, flux_time(day_start), flux_time(day_stop), f"{DOWNSAMPLE_MINUTES}m"))
+            if abc:
+                query_api.query(org=config['org'], query='import "date"\n\n' + abc_pipeline(
+                    config, abc, flux_time(day_start), flux_time(day_stop)))
+            print(f"Aggregated: {day_start:%Y-%m-%d} ({config['bucket']} --> {config['aggregate_bucket']})")
+            day_start = day_stop
+
+
+def register_tasks(config: Dict, tasks: Dict[str, str]) -> None:
+    """TASKをInfluxDBへ登録する（同名のTASKがあれば更新）"""
+    from influxdb_client import InfluxDBClient, TaskCreateRequest
+
+    with InfluxDBClient(url=config['url'], token=config['token'], org=config['org']) as client:
+        tasks_api = client.tasks_api()
+        for name, flux in tasks.items():
+            existing = tasks_api.find_tasks(name=name, org=config['org'])
+            if existing:
+                task = existing[0]
+                task.flux = flux
+                tasks_api.update_task(task)
+                print(f"TASKを更新しました: {name}")
+            else:
+                tasks_api.create_task(task_create_request=TaskCreateRequest(
+                    flux=flux, org=config['org'], status="active",
+                    description="generated by make_flux_task.py"
+                ))
+                print(f"TASKを登録しました: {name}")
+
+
+def main(argv: Optional[List[str]] = None) -> None:
+    parser = argparse.ArgumentParser(description="receive_ccm.json から InfluxDB の TASK を生成する")
+    parser.add_argument("--config", default=os.path.join(BASE_PATH, "uecs2influxdb.cfg"))
+    parser.add_argument("--ccm", default=os.path.join(BASE_PATH, "receive_ccm.json"))
+    parser.add_argument("--out", default=os.path.join(BASE_PATH, "tasks"), help="出力先ディレクトリ")
+    parser.add_argument("--register", action="store_true", help="InfluxDBへTASKを登録(更新)する")
+    args = parser.parse_args(argv)
+
+    configs = load_config(args.config)
+    ccm_rules = CCMRuleMatcher.from_file(args.ccm)
+
+    # 書き込み先が複数の場合は、それぞれのInfluxDBにTASKを登録する（出力先は tasks/<セクション名>）
+    for target, config in configs.items():
+        tasks = generate_tasks(config, ccm_rules)
+
+        out = args.out if len(configs) == 1 else os.path.join(args.out, target)
+        os.makedirs(out, exist_ok=True)
+        for name, flux in tasks.items():
+            path = os.path.join(out, TASK_FILES[name])
+            with open(path, "w", encoding="utf-8") as f:
+                f.write(flux)
+            print(f"[{target}] {name} --> {path}")
+
+        if args.register:
+            register_tasks(config, tasks)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,120 @@
+#!/usr/bin/python3
+#----------------------------------------------------------------------
+# 記録した受信データ(CCM)の再処理
+#
+#  ccm_journal.py で記録したパケットを、現在の receive_ccm.json(savemode)と
+#  解析処理で InfluxDB へ再格納する。savemode の変更や解析処理の修正後に
+#  過去データを格納し直す場合に使用する。
+#  受信間隔は再現せず、batch_size 件毎に書き込み完了を待ちながら可能な限り高速に書き込む
+#  （書き込みが追いつかずに未送信データでメモリを使い切ることはない）。
+#  savemode=diff の差分は、開始時刻前 seed_hours の記録から求めた受信値を基準にする。
+#  再格納後、同じ期間(UTCの日単位)のダウンサンプリングと時間帯別集計(ABC_*)を実行する
+#  （TASK は直近1～2日分しか集計しないため。集計しないと retention.py で削除されない）。
+#
+#  python replay.py --start "2024-11-01 00:00" --end "2024-11-02 00:00"
+#----------------------------------------------------------------------
+import argparse
+import asyncio
+import os
+import time
+from datetime import datetime, timezone
+from typing import List, Optional
+from ccm_journal import read_journal
+from make_flux_task import aggregate_range, load_config as load_task_config
+from uecs2influxdb import Config, UECSReceiver
+
+
+def to_ns(value: str) -> int:
+    """日時文字列（タイムゾーン指定なしはローカル時刻）を ns に変換"""
+    return int(datetime.fromisoformat(value).timestamp()) * 1_000_000_000
+
+
+async def replay(receiver: UECSReceiver, ccm_rules, directory: str,
+                 start_ns: int, stop_ns: int, batch_size: int = 5000, seed_ns: int = 0) -> None:
+    """指定期間のパケットを再処理する（receiver は synchronous=True で生成したもの）"""
+    started = time.time()
+    packets, written, errors = 0, 0, 0
+    batch_start = None   # 書き込み前のデータの最初の受信時刻
+
+    def flush() -> None:
+        """書き込み完了まで待つ（失敗時は再開位置を表示して中断）"""
+        try:
+            receiver.flush()
+        except Exception:
+            print(f"Write failed. Resume with --start "
+                  f"\"{datetime.fromtimestamp(batch_start / 1e9):%Y-%m-%d %H:%M:%S}\"")
+            raise
+
+    for received_ns, addr, ccm_data in read_journal(directory, start_ns - seed_ns, stop_ns):
+        if received_ns < start_ns:
+            # 開始時刻前は差分計算の基準値のみ保持する
+            try:
+                receiver.remember(ccm_data, ccm_rules)
+            except Exception as e:
+                print(f"Error processing data: {e} (from: {addr})")
+            continue
+
+        packets += 1
+        try:
+            if await receiver.handle(ccm_data, ccm_rules, received_ns, replay=True):
+                written += 1
+        except Exception as e:
+            errors += 1
+            print(f"Error processing data: {e} (from: {addr})")
+
+        if batch_start is None and receiver.pending:
+            batch_start = received_ns
+        if len(receiver.pending) >= batch_size:
+            flush()
+            batch_start = None
+
+        if packets % 100_000 == 0:
+            print(f"Replayed: {packets} packets, {written} points "
+                  f"({packets / (time.time() - started):.0f} packets/s)")
+
+    if receiver.pending:
+        flush()
+
+    elapsed = time.time() - started
+    print(f"Replay finished: {packets} packets, {written} points, {errors} errors, {elapsed:.1f}s")
+
+
+def main(argv: Optional[List[str]] = None) -> None:
+    parser = argparse.ArgumentParser(description="記録した受信データを InfluxDB へ再格納する")
+    parser.add_argument("--start", required=True, help='開始日時 例 "2024-11-01 00:00"')
+    parser.add_argument("--end", required=True, help='終了日時 例 "2024-11-02 00:00"')
+    parser.add_argument("--dir", default=None, help="記録ディレクトリ（未指定時は [journal] dir）")
+    parser.add_argument("--batch-size", type=int, default=5000, help="バッチ書き込み件数")
+    parser.add_argument("--seed-hours", type=float, default=24,
+                        help="savemode=diff の基準値を求めるため開始時刻前に読み込む時間")
+    parser.add_argument("--no-aggregate", action="store_true",
+                        help="再格納後のダウンサンプリング・時間帯別集計を行わない")
+    args = parser.parse_args(argv)
+
+    ccm_rules, config = Config.load_config()
+    directory = args.dir
+    if directory is None:
+        directory = config["journal"].get("dir", "journal") if config.has_section("journal") else "journal"
+    if not os.path.isdir(directory):
+        raise FileNotFoundError(f"Journal directory not found: {directory}")
+
+    start_ns, stop_ns = to_ns(args.start), to_ns(args.end)
+    receiver = UECSReceiver(config, listen=False, batch_size=args.batch_size, synchronous=True)
+    try:
+        asyncio.run(replay(receiver, ccm_rules, directory, start_ns, stop_ns,
+                           batch_size=args.batch_size, seed_ns=int(args.seed_hours * 3600) * 1_000_000_000))
+    finally:
+        receiver.close()   # 残りのデータを書き込んでから終了
+
+    # 再格納した期間を書き込み先毎に集計し直す
+    if not args.no_aggregate:
+        start = datetime.fromtimestamp(start_ns / 1e9, timezone.utc)
+        stop = datetime.fromtimestamp(stop_ns / 1e9, timezone.utc)
+        task_configs = load_task_config(os.path.join(os.path.dirname(os.path.abspath(__file__)), "uecs2influxdb.cfg"))
+        for target, task_config in task_configs.items():
+            print(f"[{target}] Aggregating {start:%Y-%m-%d} - {stop:%Y-%m-%d} (UTC)")
+            aggregate_range(task_config, ccm_rules, start, stop)
+
+
+if __name__ == "__main__":
+    main()
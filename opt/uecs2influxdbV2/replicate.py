@@ -1,10 +1,19 @@
+from __future__ import annotations
+
 import configparser
-import json
 import logging,os
-from datetime import datetime
-from typing import List, Dict, Any, Set
-from influxdb import InfluxDBClient
-from influxdb.exceptions import InfluxDBClientError
+import json
+from datetime import datetime, timezone
+from typing import Dict, Set, TYPE_CHECKING
+from ccm_rules import CCMRuleMatcher
+from influx_sinks import sink_targets
+
+if TYPE_CHECKING:
+    from influxdb import InfluxDBClient
+
+# 書き込み先毎に最後に移行が完了した時刻（retention.py が削除可否の判定に使用）
+#   {"influx2": "2024-11-01T00:00:00+00:00", "influx2_node2": ...}
+REPLICATE_STATE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'replicate_state.json')
 
 def setup_logging() -> None:
     """ロギングの設定"""
@@ -27,13 +36,15 @@ def load_config(config_path: str) -> configparser.ConfigParser:
         if not config.read(config_path):
             raise FileNotFoundError(f"Configuration file not found: {config_path}")
         
-        required_sections = ['influx2', 'influxdb_cloud']
+        # [sinks] で複数の書き込み先を指定している場合はすべて移行元とする
         required_params = {
-            'influx2': ['host_name', 'port', 'user', 'pass', 'database', 'bucket', 'aggregate_bucket'],
-            'influxdb_cloud': ['host_name', 'port', 'user', 'pass', 'database']
+            section: ['host_name', 'port', 'user', 'pass', 'database', 'bucket']
+            for section in sink_targets(config)
         }
+        required_params.setdefault('influx2', []).append('aggregate_bucket')
+        required_params['influxdb_cloud'] = ['host_name', 'port', 'user', 'pass', 'database']
         
-        for section in required_sections:
+        for section in required_params:
             if section not in config:
                 raise ValueError(f"Missing section: {section}")
             for param in required_params[section]:
@@ -45,22 +56,29 @@ def load_config(config_path: str) -> configparser.ConfigParser:
         logging.error(f"Failed to load configuration: {str(e)}")
         raise
 
-def load_measurement_filter(json_path: str) -> Set[str]:
+class MeasurementFilter:
+    """移行対象の measurement 判定（個別指定＋ルール指定）"""
+    def __init__(self, ccm_rules: CCMRuleMatcher):
+        self.ccm_rules = ccm_rules
+        self.extra: Set[str] = set()
+
+    def update(self, measurements) -> None:
+        """集計用など receive_ccm.json 以外の measurement を追加"""
+        self.extra.update(measurements)
+
+    def __contains__(self, measurement: str) -> bool:
+        return measurement in self.extra or bool(self.ccm_rules.lookup(measurement))
+
+def load_measurement_filter(json_path: str) -> MeasurementFilter:
     """
     receive_ccm.jsonを読み込み、移行対象のmeasurementを特定する
     """
     try:
-        with open(json_path, 'r', encoding='utf-8') as f:
-            ccm_data = json.load(f)
-        
-        # savemodeが有効な値（空でない、nullでない）のキーを抽出
-        valid_measurements = {
-            key for key, value in ccm_data.items()
-            if value.get('savemode') and value['savemode'].strip()
-        }
+        # savemodeが有効な値（空でない、nullでない）のmeasurementが対象
+        ccm_rules = CCMRuleMatcher.from_file(json_path)
         
-        logging.info(f"Loaded {len(valid_measurements)} valid measurements from {json_path}")
-        return valid_measurements
+        logging.info(f"Loaded {len(ccm_rules.exact)} measurements and {len(ccm_rules.rules)} rules from {json_path}")
+        return MeasurementFilter(ccm_rules)
     
     except Exception as e:
         logging.error(f"Failed to load measurement filter: {str(e)}")
@@ -68,6 +86,8 @@ def load_measurement_filter(json_path: str) -> Set[str]:
 
 def connect_to_database(config: Dict[str, str], is_source: bool = True) -> InfluxDBClient:
     """データベースへの接続"""
+    from influxdb import InfluxDBClient  # 起動を軽くするため接続時に読み込む
+
     db_type = "source" if is_source else "target"
     try:
         client = InfluxDBClient(
@@ -157,7 +177,7 @@ def process_bucket(
     source_client: InfluxDBClient,
     target_client: InfluxDBClient,
     bucket: str,
-    valid_measurements: Set[str]
+    valid_measurements: MeasurementFilter
 ) -> None:
     """バケット単位でのデータ処理"""
     try:
@@ -179,34 +199,64 @@ def process_bucket(
         logging.error(f"Error processing bucket {bucket}: {str(e)}")
         raise
 
+def save_replicated(source: str, completed: datetime) -> None:
+    """書き込み先の移行完了時刻を記録する"""
+    state = {}
+    if os.path.exists(REPLICATE_STATE):
+        with open(REPLICATE_STATE, 'r') as f:
+            state = json.load(f)
+    # 旧形式（書き込み先が1台のみの記録）は influx2 の記録とする
+    legacy = state.pop('last_completed', None)
+    if legacy:
+        state.setdefault('influx2', legacy)
+    state[source] = completed.isoformat()
+
+    tmp = REPLICATE_STATE + '.tmp'
+    with open(tmp, 'w') as f:
+        json.dump(state, f, indent=2)
+    os.replace(tmp, REPLICATE_STATE)
+
 def main() -> None:
     """メイン処理"""
     setup_logging()
+    started_at = datetime.now(timezone.utc)
     try:
         # 設定の読み込み
         config = load_config('uecs2influxdb.cfg')
-        valid_measurements = load_measurement_filter('receive_ccm.json') #set
+        valid_measurements = load_measurement_filter('receive_ccm.json')
         #集計用measurementを追加指定
-        valid_measurements.update(['ABC_0-6', 'ABC_6-12', 'ABC_12-18', 'ABC_18-24'])  # setに複数要素を追加
+        valid_measurements.update(['ABC_0-6', 'ABC_6-12', 'ABC_12-18', 'ABC_18-24'])
 
-        source_config = config['influx2']
         target_config = config['influxdb_cloud']
 
-        # データベース接続
-        source_client = connect_to_database(source_config, is_source=True)
+        # ターゲットデータベース接続
         target_client = connect_to_database(target_config, is_source=False)
-
-        # ターゲットデータベースの確認
         ensure_target_database(target_client, target_config['database'])
         target_client.switch_database(target_config['database'])
 
-        # バケットの処理
-        buckets = [source_config['bucket'], source_config['aggregate_bucket']]
-        for bucket in buckets:
-            logging.info(f"Starting processing bucket: {bucket}")
-            process_bucket(source_client, target_client, bucket, valid_measurements)
-            logging.info(f"Completed processing bucket: {bucket}")
+        # 書き込み先([sinks])毎に移行し、完了した書き込み先は開始時刻までを移行済みとして記録する
+        failed = []
+        for source in sink_targets(config):
+            source_config = config[source]
+            source_client = None
+            try:
+                source_client = connect_to_database(source_config, is_source=True)
+                aggregate_bucket = source_config.get('aggregate_bucket', config['influx2']['aggregate_bucket'])
+                buckets = [source_config['bucket'], aggregate_bucket]
+                for bucket in buckets:
+                    logging.info(f"Starting processing bucket: {bucket} ({source})")
+                    process_bucket(source_client, target_client, bucket, valid_measurements)
+                    logging.info(f"Completed processing bucket: {bucket} ({source})")
+                save_replicated(source, started_at)
+            except Exception as e:
+                logging.error(f"Migration failed ({source}): {str(e)}")
+                failed.append(source)
+            finally:
+                if source_client:
+                    source_client.close()
 
+        if failed:
+            raise RuntimeError(f"Migration failed: {', '.join(failed)}")
         logging.info("Migration completed successfully")
 
     except Exception as e:
@@ -214,8 +264,6 @@ def main() -> None:
         raise
     finally:
         # クライアントの接続を閉じる
-        if 'source_client' in locals():
-            source_client.close()
         if 'target_client' in locals():
             target_client.close()
 
@@ -0,0 +1,360 @@
+#----------------------------------------------------------------------
+# 保存期間の管理（raw data の削除）
+#
+#  ダウンサンプリング済み(aggregate bucket に格納済)かつ
+#  クラウド連携済み(replicate.py の完了時刻以前)の raw data
+#  (downsample="0")を、keep_hours 経過後に削除する。
+#  savemode=abc の measurement は時間帯別集計(ABC_*)済みの時刻までに限る
+#  （集計は2日前のデータを対象とするため、最低でも48時間は保持される）。
+#  削除前に chunk 毎に aggregate bucket に集計値があるか(10分毎)を確認し、
+#  ダウンサンプリングされていない範囲（TASK停止中の期間等）は削除しない。
+#
+#  ・削除は chunk_hours 単位の時間範囲毎に、古い時間範囲から全 measurement について実行
+#    （max_chunks で中断しても、次回は残った古いデータから再開する）
+#  ・削除の間に pause_sec 待機し、書き込みを妨げないようにする
+#  ・off_peak で指定した時間帯のみ実行する
+#
+#  uecs2influxdb.cfg
+#      [retention]
+#      keep_hours=24
+#      chunk_hours=24
+#      pause_sec=5
+#      off_peak=1-5
+#----------------------------------------------------------------------
+import configparser
+import json
+import logging,os
+import time
+import argparse
+from typing import Dict, Optional, Set, Tuple
+from datetime import datetime, timedelta, timezone
+from ccm_rules import CCMRuleMatcher
+from influx_sinks import sink_targets
+from make_flux_task import DOWNSAMPLE_MINUTES, flux_time
+
+BASE_PATH = os.path.dirname(os.path.abspath(__file__))
+REPLICATE_STATE = os.path.join(BASE_PATH, 'replicate_state.json')
+
+logger = logging.getLogger(__name__)
+
+def setup_logging() -> None:
+    """ロギングの設定"""
+    log_dir = 'log'
+    os.makedirs(log_dir, exist_ok=True)
+    log_filename = os.path.join(log_dir, f'retention_{datetime.now().strftime("%Y%m%d_%H%M%S")}.log')
+
+    logging.basicConfig(
+        level=logging.INFO,
+        format='%(asctime)s - %(levelname)s - %(message)s',
+        handlers=[ logging.FileHandler(log_filename),
+        logging.StreamHandler()
+        ]
+    )
+
+def load_replicated_until(section: str) -> Optional[datetime]:
+    """replicate.py が書き込み先の移行を最後に完了した時刻（この時刻までのデータはクラウド連携済）"""
+    if not os.path.exists(REPLICATE_STATE):
+        return None
+    with open(REPLICATE_STATE, 'r') as f:
+        state = json.load(f)
+    completed = state.get(section)
+    if completed is None and section == 'influx2':
+        completed = state.get('last_completed')   # 旧形式（書き込み先が1台のみの記録）
+    return datetime.fromisoformat(completed) if completed else None
+
+def floor_time(dt: datetime, step: timedelta) -> datetime:
+    """step 単位(UTC基準)に切り捨てる"""
+    epoch = datetime(1970, 1, 1, tzinfo=timezone.utc)
+    return epoch + (dt - epoch) // step * step
+
+def in_off_peak(spec: str, now: datetime) -> bool:
+    """現在時刻が off_peak（例 "1-5" は1時～5時台）に含まれるか"""
+    if not spec.strip():
+        return True
+    start, _, stop = spec.partition('-')
+    start, stop = int(start), int(stop or start)
+    if start <= stop:
+        return start <= now.hour <= stop
+    return now.hour >= start or now.hour <= stop   # 日をまたぐ指定 (例 22-4)
+
+class RetentionJob:
+    def __init__(self, config: configparser.ConfigParser, section: str, ccm_rules: CCMRuleMatcher,
+                 dry_run: bool = False):
+        """
+        書き込み先1台分の保存期間管理
+
+        Args:
+            config: uecs2influxdb.cfg
+            section (str): InfluxDBの設定セクション名
+            ccm_rules: receive_ccm.json の照合器（savemode=abc の判定に使用）
+            dry_run (bool): 削除せず対象のみ表示する
+        """
+        target = config[section]
+        retention = config['retention'] if config.has_section('retention') else {}
+        self.name = section
+        self.url = target['url']
+        self.org = target['org'].strip()
+        self.token = target['token'].strip()
+        self.bucket = target['bucket']
+        self.aggregate_bucket = target.get('aggregate_bucket', config['influx2']['aggregate_bucket'])
+
+        self.keep = timedelta(hours=float(retention.get('keep_hours', 24)))
+        self.window = timedelta(minutes=DOWNSAMPLE_MINUTES)
+        # chunk は集計間隔の倍数とする（集計済みかを集計間隔単位で判定するため）
+        chunk = timedelta(hours=float(retention.get('chunk_hours', 24)))
+        self.chunk = max(chunk // self.window * self.window, self.window)
+        self.pause_sec = float(retention.get('pause_sec', 5))
+        self.max_chunks = int(retention.get('max_chunks', 500))
+        self.lookback_days = int(retention.get('lookback_days', 30))
+        self.off_peak = retention.get('off_peak', '')
+        # クラウド連携を使用する場合は連携済のデータのみ削除する
+        cloud_host = config['influxdb_cloud'].get('host_name', '').strip() if config.has_section('influxdb_cloud') else ''
+        self.require_replication = str(retention.get('require_replication', bool(cloud_host))).lower() in ('1', 'true', 'yes')
+        self.ccm_rules = ccm_rules
+        self.dry_run = dry_run
+        self.client = None
+
+    def connect(self):
+        """InfluxDBに接続"""
+        from influxdb_client import InfluxDBClient  # 起動を軽くするため接続時に読み込む
+
+        self.client = InfluxDBClient(url=self.url, token=self.token, org=self.org, timeout=60_000)
+        self.client.ping()
+        logger.info(f"[{self.name}] InfluxDBに接続成功")
+
+    def _query_times(self, query: str, key: str = "_measurement") -> Dict[str, datetime]:
+        """measurement(key 列の値) --> 時刻 の辞書を返すクエリを実行"""
+        result = {}
+        for table in self.client.query_api().query(org=self.org, query=query):
+            for record in table.records:
+                result[record.values.get(key)] = record.get_time()
+        return result
+
+    def get_downsample_progress(self) -> Dict[str, datetime]:
+        """measurement 毎のダウンサンプリング済みの最新時刻"""
+        return self._query_times(f'''
+        from(bucket: "{self.aggregate_bucket}")
+            |> range(start: -{self.lookback_days}d)
+            |> filter(fn: (r) => r._field == "value" and r._measurement !~ /^ABC_/)
+            |> last()
+            |> keep(columns: ["_measurement", "_time"])
+            |> group(columns: ["_measurement"])
+            |> sort(columns: ["_time"])
+            |> last(column: "_time")
+        ''')
+
+    def get_abc_progress(self) -> Dict[str, datetime]:
+        """savemode=abc の measurement 毎の時間帯別集計(ABC_*)済みの最新時刻"""
+        return self._query_times(f'''
+        from(bucket: "{self.aggregate_bucket}")
+            |> range(start: -{self.lookback_days}d)
+            |> filter(fn: (r) => r._field == "value" and r._measurement =~ /^ABC_/)
+            |> last()
+            |> keep(columns: ["original_measurement", "_time"])
+            |> group(columns: ["original_measurement"])
+            |> sort(columns: ["_time"])
+            |> last(column: "_time")
+        ''', key="original_measurement")
+
+    def get_oldest_raw(self, stop: datetime) -> Dict[str, datetime]:
+        """measurement 毎の最も古い raw data の時刻"""
+        return self._query_times(f'''
+        from(bucket: "{self.bucket}")
+            |> range(start: 1970-01-01T00:00:00Z, stop: {flux_time(stop)})
+            |> filter(fn: (r) => r._field == "value" and r.downsample == "0")
+            |> first()
+            |> keep(columns: ["_measurement", "_time"])
+            |> group(columns: ["_measurement"])
+            |> sort(columns: ["_time"])
+            |> first(column: "_time")
+        ''')
+
+    def count_raw(self, measurement: str, start: datetime, stop: datetime) -> Tuple[Set[tuple], int]:
+        """指定範囲の raw data の series(tagの組)・point 数"""
+        query = f'''
+        from(bucket: "{self.bucket}")
+            |> range(start: {flux_time(start)}, stop: {flux_time(stop)})
+            |> filter(fn: (r) => r._measurement == "{measurement}")
+            |> filter(fn: (r) => r._field == "value" and r.downsample == "0")
+            |> count()
+        '''
+        series, points = set(), 0
+        for table in self.client.query_api().query(org=self.org, query=query):
+            for record in table.records:
+                series.add(tuple(sorted((k, v) for k, v in record.values.items()
+                                        if k not in ('result', 'table', '_start', '_stop', '_time', '_value'))))
+                points += int(record.get_value())
+        return series, points
+
+    def _query_counts(self, query: str) -> Dict[str, int]:
+        """measurement --> 件数 の辞書を返すクエリを実行"""
+        result = {}
+        for table in self.client.query_api().query(org=self.org, query=query):
+            for record in table.records:
+                result[record.get_measurement()] = int(record.get_value())
+        return result
+
+    def get_coverage(self, start: datetime, stop: datetime,
+                     measurement: Optional[str] = None) -> Dict[str, Tuple[int, int]]:
+        """measurement 毎の (raw data がある集計間隔の数, そのうち集計値がある数)
+
+        start / stop は集計間隔の倍数とする。ダウンサンプリングTASKの集計値は
+        集計間隔の終了時刻で格納されるため、aggregate bucket は (start, stop] を数える
+        （手書きの downsampling.flux は downsample="0" のまま格納するため tag では絞らない）。
+        """
+        measurement_filter = f' and r._measurement == "{measurement}"' if measurement else ''
+        window = f"{DOWNSAMPLE_MINUTES}m"
+        raw = self._query_counts(f'''
+        from(bucket: "{self.bucket}")
+            |> range(start: {flux_time(start)}, stop: {flux_time(stop)})
+            |> filter(fn: (r) => r._field == "value" and r.downsample == "0"{measurement_filter})
+            |> group(columns: ["_measurement"])
+            |> aggregateWindow(every: {window}, fn: count, createEmpty: false)
+            |> count()
+        ''')
+        aggregated = self._query_counts(f'''
+        from(bucket: "{self.aggregate_bucket}")
+            |> range(start: {flux_time(start + timedelta(seconds=1))}, stop: {flux_time(stop + timedelta(seconds=1))})
+            |> filter(fn: (r) => r._field == "value"{measurement_filter})
+            |> group(columns: ["_measurement"])
+            |> aggregateWindow(every: {window}, fn: count, createEmpty: false)
+            |> count()
+        ''')
+        return {m: (count, min(count, aggregated.get(m, 0))) for m, count in raw.items()}
+
+    def get_cutoffs(self, now: datetime) -> Dict[str, datetime]:
+        """measurement 毎の削除可能な時刻（これより前を削除）"""
+        replicated_until = load_replicated_until(self.name)
+        if self.require_replication and replicated_until is None:
+            logger.warning(f"[{self.name}] クラウド連携(replicate.py)の完了記録がないため削除しません")
+            return {}
+
+        abc_progress = self.get_abc_progress()
+        cutoffs = {}
+        for measurement, progress in self.get_downsample_progress().items():
+            cutoff = min(progress, now) - self.keep
+            if self.require_replication:
+                cutoff = min(cutoff, replicated_until)
+            # savemode=abc は時間帯別集計が済んだ範囲のみ（未集計の場合は削除しない）
+            if self.ccm_rules.lookup(measurement) == 'abc':
+                if measurement not in abc_progress:
+                    logger.info(f"[{self.name}] {measurement}: 時間帯別集計(ABC_*)が未実施のため削除しません")
+                    continue
+                cutoff = min(cutoff, abc_progress[measurement])
+            cutoffs[measurement] = floor_time(cutoff, self.window)
+        return cutoffs
+
+    def run(self, force: bool = False) -> Dict[str, int]:
+        """削除を実行し、削除した measurement/series/point 数を返す
+
+        chunk_hours 単位の時間範囲を古い方から順に、その範囲に削除対象のある
+        measurement を古いデータから順に削除する。measurement 名の順ではないため、
+        max_chunks で中断しても特定の measurement が削除されずに残り続けることはない。
+        """
+        total = {'measurements': 0, 'series': 0, 'points': 0, 'chunks': 0, 'skipped': 0}
+        now = datetime.now(timezone.utc)
+
+        cutoffs = self.get_cutoffs(now)
+        oldest = self.get_oldest_raw(max(cutoffs.values())) if cutoffs else {}
+        backlog = {m: (oldest[m], cutoff) for m, cutoff in cutoffs.items() if m in oldest and oldest[m] < cutoff}
+        if not backlog:
+            logger.info(f"[{self.name}] 削除対象はありません")
+            return total
+        for measurement, (start, cutoff) in sorted(backlog.items(), key=lambda item: (item[1][0], item[0])):
+            logger.info(f"[{self.name}] {measurement}: {start:%Y-%m-%d %H:%M} - {cutoff:%Y-%m-%d %H:%M}")
+
+        delete_api = self.client.delete_api()
+        deleted_series: Set[tuple] = set()
+        deleted_measurements: Set[str] = set()
+        interrupted = None
+
+        chunk_start = floor_time(min(start for start, _ in backlog.values()), self.chunk)
+        last_cutoff = max(cutoff for _, cutoff in backlog.values())
+        while chunk_start < last_cutoff and not interrupted:
+            chunk_end = chunk_start + self.chunk
+            targets = sorted((m for m, (start, cutoff) in backlog.items() if start < chunk_end and chunk_start < cutoff),
+                             key=lambda m: (backlog[m][0], m))
+            coverage: Dict[datetime, Dict[str, Tuple[int, int]]] = {}   # 終了時刻毎の集計状況
+
+            for measurement in targets:
+                if total['chunks'] >= self.max_chunks:
+                    interrupted = f"削除回数の上限({self.max_chunks})に達しました"
+                    break
+                if not force and not in_off_peak(self.off_peak, datetime.now()):
+                    interrupted = f"実行時間帯({self.off_peak}時)を過ぎたため中断します"
+                    break
+
+                chunk_stop = min(chunk_end, backlog[measurement][1])
+                if chunk_stop not in coverage:
+                    coverage[chunk_stop] = self.get_coverage(chunk_start, chunk_stop)
+                windows, covered = coverage[chunk_stop].get(measurement, (0, 0))
+                if windows == 0:
+                    continue
+                if covered < windows:
+                    logger.warning(f"[{self.name}] {measurement}: {chunk_start:%Y-%m-%d %H:%M} - {chunk_stop:%Y-%m-%d %H:%M} "
+                                   f"はダウンサンプリングされていないため削除しません（集計済み {covered}/{windows}）")
+                    total['skipped'] += 1
+                    continue
+
+                series, points = self.count_raw(measurement, chunk_start, chunk_stop)
+                if not self.dry_run:
+                    delete_api.delete(
+                        start=chunk_start, stop=chunk_stop,
+                        predicate=f'_measurement="{measurement}" AND downsample="0"',
+                        bucket=self.bucket, org=self.org
+                    )
+                    time.sleep(self.pause_sec)
+                # 実際に削除した chunk のみ集計する
+                total['chunks'] += 1
+                total['points'] += points
+                deleted_series |= series
+                deleted_measurements.add(measurement)
+
+            chunk_start = chunk_end
+
+        total['series'] = len(deleted_series)
+        total['measurements'] = len(deleted_measurements)
+        if interrupted:
+            logger.warning(f"[{self.name}] {interrupted}（残りは次回、古いデータから削除します）")
+        return total
+
+    def close(self):
+        if self.client:
+            self.client.close()
+
+def main():
+    parser = argparse.ArgumentParser(description="ダウンサンプリング・クラウド連携済みの raw data を削除する")
+    parser.add_argument("--config", default=os.path.join(BASE_PATH, "uecs2influxdb.cfg"))
+    parser.add_argument("--ccm", default=os.path.join(BASE_PATH, "receive_ccm.json"))
+    parser.add_argument("--dry-run", action="store_true", help="削除せず対象のみ表示する")
+    parser.add_argument("--force", action="store_true", help="off_peak の時間帯外でも実行する")
+    args = parser.parse_args()
+
+    setup_logging()
+    config = configparser.ConfigParser()
+    if not config.read(args.config):
+        raise FileNotFoundError(f"Configuration file not found: {args.config}")
+
+    ccm_rules = CCMRuleMatcher.from_file(args.ccm)
+
+    off_peak = config['retention'].get('off_peak', '') if config.has_section('retention') else ''
+    if not args.force and not in_off_peak(off_peak, datetime.now()):
+        logger.info(f"実行時間帯({off_peak}時)外のため終了します")
+        return
+
+    # [sinks] で複数の書き込み先を指定している場合はそれぞれ削除する
+    for target in sink_targets(config):
+        job = RetentionJob(config, target, ccm_rules, dry_run=args.dry_run)
+        try:
+            job.connect()
+            total = job.run(force=args.force)
+            logger.info(f"[{target}] {'削除対象' if args.dry_run else '削除完了'}: measurements={total['measurements']} "
+                        f"series={total['series']} points={total['points']} chunks={total['chunks']} "
+                        f"skipped={total['skipped']}")
+        except Exception as e:
+            logger.error(f"[{target}] 削除処理に失敗: {e}")
+        finally:
+            job.close()
+
+if __name__ == "__main__":
+    main()
@@ -1,69 +1,52 @@
 #!/usr/bin/python3
 
 import os
+import signal
 from socket import *
 import time
-from datetime import datetime
-import pandas as pd
 import xmltodict
 import json
 import configparser
-from typing import Dict, Set
-from dataclasses import dataclass
-from influxdb_client import InfluxDBClient, WriteOptions
-from influxdb_client.client.write_api import SYNCHRONOUS
-
-@dataclass
-class CCMFlags:
-    """CCMフラグを管理するデータクラス"""
-    flag_up: Set[str]
-    flag_diff: Set[str]
-    flag_max: Set[str]
-    flag_abc: Set[str]
+from typing import Dict, List, Optional
+from ccm_rules import CCMRuleMatcher
+from ccm_journal import load_journal
+from influx_sinks import load_sinks
 
 class Config:
     """設定を管理するクラス"""
     @staticmethod
-    def load_config() -> tuple[CCMFlags, configparser.ConfigParser]:
+    def load_config() -> tuple[CCMRuleMatcher, configparser.ConfigParser]:
         """設定ファイルを読み込む"""
         base_path = os.path.dirname(os.path.abspath(__file__))
         
-        # CCM設定の読み込み
-        with open(f'{base_path}/receive_ccm.json', 'r') as f:
-            json_load = json.load(f)
-        
-        up_, diff_, max_, abc_ = [], [], [], []
-        
-        for data in json_load.values():
-            recv_ccm = f"{data['type'].split('.')[0]}_{data['room']}_{data['region']}_{data['order']}".lower()
-            
-            if data["savemode"]:
-                up_.append(recv_ccm)
-                if data["savemode"] == "diff":
-                    diff_.append(recv_ccm)
-                elif data["savemode"] in ("on", "off"):
-                    max_.append(recv_ccm)
-                elif data["savemode"] == "abc":
-                    abc_.append(recv_ccm)
-        
-        ccm_flags = CCMFlags(
-            flag_up=set(up_),
-            flag_diff=set(diff_),
-            flag_max=set(max_),
-            flag_abc=set(abc_)
-        )
+        # CCM設定の読み込み（ルール指定は照合器へコンパイル）
+        ccm_rules = CCMRuleMatcher.from_file(f'{base_path}/receive_ccm.json')
         
         # InfluxDB設定の読み込み
         config = configparser.ConfigParser()
         config.read(f'{base_path}/uecs2influxdb.cfg')
         
-        return ccm_flags, config
+        return ccm_rules, config
 
 class UECSReceiver:
     """UECSデータ受信とInfluxDBへの書き込みを行うクラス"""
-    def __init__(self, config: configparser.ConfigParser):
-        self.setup_udp()
-        self.setup_influxdb(config)
+    def __init__(self, config: configparser.ConfigParser, listen: bool = True, batch_size: int = 500,
+                 port: int = 16520, synchronous: bool = False):
+        """
+        Args:
+            config: uecs2influxdb.cfg
+            listen (bool): UDP受信を行う（replay.py での再処理時は False）
+            batch_size (int): InfluxDBへのバッチ書き込み件数
+            port (int): UDP受信ポート（0 は空きポート。bench_startup.py で使用）
+            synchronous (bool): 書き込みデータを pending に溜め、flush() で書き込み完了まで待つ
+                                （replay.py で書き込みが追いつかずメモリを使い切らないようにする）
+        """
+        self.journal = None
+        self.udp_socket = None
+        if listen:
+            self.setup_udp(port)
+            self.journal = load_journal(config)
+        self.setup_influxdb(config, batch_size, synchronous)
     
     def setup_udp(self, port: int = 16520):
         """UDPソケットの設定"""
@@ -71,16 +54,16 @@ class UECSReceiver:
         self.udp_socket.bind(("", port))
         self.BUFSIZE = 512
     
-    def setup_influxdb(self, config: configparser.ConfigParser):
-        """InfluxDB接続の設定"""
-        self.bucket = config["influx2"]["bucket"]
-        self.client = InfluxDBClient.from_config_file(
-            os.path.join(os.path.dirname(os.path.abspath(__file__)), 'uecs2influxdb.cfg')
-        )
-        self.write_api = self.client.write_api(write_options=SYNCHRONOUS)
-        self.query_api = self.client.query_api()
+    def setup_influxdb(self, config: configparser.ConfigParser, batch_size: int = 500,
+                       synchronous: bool = False):
+        """InfluxDB接続の設定（[sinks] で複数の書き込み先を指定可能）"""
+        self.sinks = load_sinks(config, batch_size=batch_size, synchronous=synchronous)
+        self.synchronous = synchronous
+        self.pending: List[Dict] = []
+        # 差分計算用に savemode=diff の最新の受信値（差分を取る前の値）を保持する
+        self.last_readings: Dict[str, float] = {}
     
-    def process_ccm_data(self, ccm_data: bytes) -> Dict:
+    def process_ccm_data(self, ccm_data: bytes, received_ns: Optional[int] = None) -> Dict:
         """CCMデータの解析"""
         dictionary = xmltodict.parse(ccm_data)
         json_data = json.loads(json.dumps(dictionary).replace('@', '').replace('#', ''))
@@ -91,74 +74,125 @@ class UECSReceiver:
         return {
             "measurement": measurement,
             "value": float(data["text"]),
-            "priority": data["priority"]
+            "priority": data["priority"],
+            "time": received_ns or time.time_ns()
         }
     
-    async def get_last_value(self, measurement: str) -> float:
-        """過去のデータを取得"""
+    async def get_last_value(self, measurement: str, before_ns: Optional[int] = None) -> float:
+        """前回の受信値を取得（before_ns 指定時はその時刻より前の値）
+
+        起動直後はDBに格納した差分前の値(field "raw")を参照する。
+        """
+        if measurement in self.last_readings:
+            return self.last_readings[measurement]
+
+        sink = self.sinks.query_sink(measurement)
+        if sink is None:
+            return 0.0
+
+        time_range = "start: -1y"
+        if before_ns is not None:
+            time_range = f"start: time(v: {before_ns - 365 * 86400 * 1_000_000_000}), stop: time(v: {before_ns})"
+
         query = f'''
-            from(bucket: "{self.bucket}")
-                |> range(start: -1y)
+            from(bucket: "{sink.bucket}")
+                |> range({time_range})
                 |> filter(fn: (r) => r["_measurement"] == "{measurement}")
                 |> filter(fn: (r) => r["cloud"] == "0" and r["downsample"] == "0")
-                |> filter(fn: (r) => r["_field"] == "value")
+                |> filter(fn: (r) => r["_field"] == "raw")
                 |> last()
         '''
         
-        tables = self.query_api.query(query)
+        tables = sink.query_api.query(query, org=sink.org)
         for table in tables:
             for record in table.records:
                 return float(record["_value"])
         return 0.0
     
     def write_to_influxdb(self, data: Dict):
-        """InfluxDBへの書き込み"""
-        write_options = WriteOptions(
-            batch_size=500,
-            flush_interval=10_000,
-            jitter_interval=2_000,
-            retry_interval=5_000,
-            max_retries=5,
-            max_retry_delay=30_000,
-            exponential_base=2
-        )
+        """InfluxDBへの書き込み（担当シンクのバッチ書き込みキューへ追加）"""
+        influx_data = {
+            "measurement": data["measurement"],
+            "tags": {"cloud": "0", "downsample": "0","priority":data["priority"]},
+            "fields": {"value": data["value"]},
+            "time": data["time"]
+        }
+        if "raw" in data:
+            influx_data["fields"]["raw"] = data["raw"]   # 差分前の値（再起動後の差分計算に使用）
+        if self.synchronous:
+            self.pending.append(influx_data)
+        else:
+            self.sinks.write(influx_data)
+
+    def flush(self) -> int:
+        """pending のデータを書き込み完了まで待って書き込む（synchronous 時）"""
+        pending, self.pending = self.pending, []
+        if not pending:
+            return 0
+        return self.sinks.write_batch(pending)
+
+    async def handle(self, ccm_data: bytes, ccm_rules: CCMRuleMatcher,
+                     received_ns: Optional[int] = None, replay: bool = False) -> bool:
+        """受信データを解析して格納する（格納した場合 True）"""
+        data = self.process_ccm_data(ccm_data, received_ns)
+        savemode = ccm_rules.lookup(data["measurement"])
+        
+        if not savemode:
+            return False
+        
+        # 差分計算（前回の差分ではなく前回の受信値との差）
+        if savemode == "diff":
+            last_value = await self.get_last_value(
+                data["measurement"], before_ns=data["time"] if replay else None)
+            data["raw"] = data["value"]
+            data["value"] = abs(data["raw"] - last_value)
+            self.last_readings[data["measurement"]] = data["raw"]
         
-        with self.client.write_api(write_options=write_options) as write_client:
-            influx_data = {
-                "measurement": data["measurement"],
-                "tags": {"cloud": "0", "downsample": "0","priority":data["priority"]},
-                "fields": {"value": data["value"]}
-            }
-            write_client.write(bucket=self.bucket, record=influx_data)
+        # 四捨五入
+        if savemode in ("on", "off"):
+            data["value"] = round(data["value"])
+        
+        self.write_to_influxdb(data)
+        return True
+
+    def remember(self, ccm_data: bytes, ccm_rules: CCMRuleMatcher) -> None:
+        """格納せずに受信値のみ保持する（replay.py で開始時刻前の記録から差分の基準値を求める）"""
+        data = self.process_ccm_data(ccm_data)
+        if ccm_rules.lookup(data["measurement"]) == "diff":
+            self.last_readings[data["measurement"]] = data["value"]
+
+    def close(self):
+        """未送信データを書き込んで接続を閉じる"""
+        # 書き込みの完了(再試行を含む)を待つ間も受信ポートを占有しないよう先に閉じる
+        if self.udp_socket:
+            self.udp_socket.close()
+            self.udp_socket = None
+        if self.journal:
+            self.journal.close()
+        try:
+            self.flush()
+        finally:
+            self.sinks.close()
     
-    async def receive(self, ccm_flags: CCMFlags, debug: bool = False, debug_sec: float = None):
+    async def receive(self, ccm_rules: CCMRuleMatcher, debug: bool = False, debug_sec: float = None):
         """UECSデータの受信とデータ処理"""
         start_time = time.time()
         debug_count = 0
         
         while True:
             ccm_data, addr = self.udp_socket.recvfrom(self.BUFSIZE)
+            received_ns = time.time_ns()
+            if self.journal:
+                try:
+                    self.journal.append(ccm_data, addr, received_ns)
+                except OSError as e:
+                    print(f"Error writing journal: {e}")
             if debug:
                 print(f"Received: {ccm_data.decode()}, from: {addr}")
                 debug_count += 1
             
             try:
-                data = self.process_ccm_data(ccm_data)
-                
-                if data["measurement"] not in ccm_flags.flag_up:
-                    continue
-                
-                # 差分計算
-                if data["measurement"] in ccm_flags.flag_diff:
-                    last_value = await self.get_last_value(data["measurement"])
-                    data["value"] = abs(data["value"] - last_value)
-                
-                # 四捨五入
-                if data["measurement"] in ccm_flags.flag_max:
-                    data["value"] = round(data["value"])
-                
-                self.write_to_influxdb(data)
-                
+                await self.handle(ccm_data, ccm_rules, received_ns)
             except Exception as e:
                 print(f"Error processing data: {e}")
             
@@ -166,23 +200,30 @@ class UECSReceiver:
                 print(f"Debug time: {time.time() - start_time:.2f}s, Messages: {debug_count}")
                 break
 
+def _terminate(signum, frame):
+    """SIGTERM(systemctl stop 等)でも未送信データを書き込んでから終了する"""
+    raise SystemExit(0)
+
 def main():
     """メイン処理"""
+    receiver = None
+    signal.signal(signal.SIGTERM, _terminate)
     try:
-        ccm_flags, config = Config.load_config()
+        ccm_rules, config = Config.load_config()
         receiver = UECSReceiver(config)
         
         import asyncio
         asyncio.run(receiver.receive(
-            ccm_flags,
+            ccm_rules,
             debug=True,
             debug_sec=None  # デバッグ時間を指定する場合は数値を設定
         ))
         
-    except KeyboardInterrupt:
+    except (KeyboardInterrupt, SystemExit):
         print("\nShutting down...")
     finally:
-        receiver.client.close()
+        if receiver:
+            receiver.close()   # バッチ書き込み中のデータと記録ファイルを書き出す
 
 if __name__ == "__main__":
     main()